@@ -0,0 +1,166 @@
+"""
+Copyright 2023 laynholt
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import aiofiles
+from aiohttp import ClientSession, ClientError, ClientTimeout, TCPConnector
+
+from yandex_music.exceptions import NetworkError
+
+import config
+from libs import network
+
+
+class AsyncEngine:
+    """
+    Асинхронный движок загрузки.
+
+    Все передачи данных (треки и обложки) выполняются в одном event loop'е, который крутится в отдельном потоке.
+    Блокирующие вызовы (API Яндекс Музыки, теги, база данных) выполняются в небольшом пуле потоков.
+    """
+
+    def __init__(self, number_of_executor_workers: int = config.ASYNC_NUMBER_OF_EXECUTOR_WORKERS,
+                 connections_limit: int = config.ASYNC_CONNECTIONS_LIMIT):
+        self._connections_limit = connections_limit
+        self._executor = ThreadPoolExecutor(max_workers=number_of_executor_workers,
+                                            thread_name_prefix='ymd-engine')
+
+        self._loop = asyncio.new_event_loop()
+        self._loop.set_default_executor(self._executor)
+        self._thread = threading.Thread(target=self._run_loop, daemon=True)
+        self._thread.start()
+
+        self._session = None
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_forever()
+
+    def submit(self, coro):
+        """
+        Запускает корутину в event loop'е движка
+
+        :param coro: корутина
+        :return: concurrent.futures.Future с результатом корутины
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self._loop)
+
+    async def run_blocking(self, func, *args):
+        """
+        Выполняет блокирующую функцию в пуле потоков движка
+
+        :param func: функция
+        :param args: аргументы функции
+        :return: результат функции
+        """
+        return await self._loop.run_in_executor(self._executor, func, *args)
+
+    def _get_session(self) -> ClientSession:
+        # Сессия создаётся лениво и только внутри event loop'а движка
+        if self._session is None or self._session.closed:
+            self._session = ClientSession(
+                connector=TCPConnector(limit=self._connections_limit),
+                timeout=ClientTimeout(total=None, sock_connect=config.ASYNC_CONNECT_TIMEOUT,
+                                      sock_read=config.ASYNC_READ_TIMEOUT)
+            )
+        return self._session
+
+    async def download(self, url: str, filename: str, part_filename: str = None,
+                       chunk_size: int = config.ASYNC_CHUNK_SIZE, throttle=None, cancel_token=None):
+        """
+        Скачивает файл по ссылке во временный .part файл, докачивая его с места обрыва через HTTP Range,
+        и переименовывает в итоговый только после полной загрузки. При отмене временный файл удаляется.
+
+        :param url: прямая ссылка на файл
+        :param filename: путь, куда сохранить файл
+        :param part_filename: путь к временному файлу (None - имя файла с суффиксом .part)
+        :param chunk_size: размер блока чтения
+        :param throttle: доля ограничителя скорости (network.BandwidthLimiter.Share)
+        :param cancel_token: токен отмены загрузки (network.CancellationToken)
+        :return:
+        """
+        part_filename = network.get_part_filename(filename) if part_filename is None else part_filename
+        offset = network.get_resume_offset(part_filename)
+
+        try:
+            async with self._get_session().get(url, headers=network.get_range_headers(offset)) as response:
+                mode, expected_size = network.check_resume_response(response.status, response.headers,
+                                                                    offset, part_filename)
+                if mode is not None:
+                    async with aiofiles.open(part_filename, mode) as file:
+                        async for chunk in response.content.iter_chunked(chunk_size):
+                            if cancel_token is not None and cancel_token.is_cancelled():
+                                raise network.DownloadCancelledError(f'Загрузка [{filename}] отменена.')
+                            await file.write(chunk)
+                            if throttle is not None:
+                                await throttle.consume_async(len(chunk))
+        except (ClientError, asyncio.TimeoutError) as e:
+            raise NetworkError(e)
+        except (asyncio.CancelledError, network.DownloadCancelledError):
+            if os.path.exists(part_filename):
+                os.remove(part_filename)
+            raise
+
+        network.finish_part_file(part_filename, filename, expected_size)
+
+    def close(self):
+        """
+        Закрывает сессию и останавливает event loop движка
+
+        :return:
+        """
+        async def _close_session():
+            if self._session is not None:
+                await self._session.close()
+
+        if self._loop.is_running():
+            self.submit(_close_session()).result()
+            self._loop.call_soon_threadsafe(self._loop.stop)
+        self._executor.shutdown(wait=False)
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_engine() -> AsyncEngine:
+    """
+    Возвращает общий для всего процесса асинхронный движок, создавая его при первом обращении
+
+    :return:
+    """
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = AsyncEngine()
+        return _engine
+
+
+def close_engine():
+    """
+    Останавливает асинхронный движок, если он был создан (при завершении программы)
+
+    :return:
+    """
+    global _engine
+    with _engine_lock:
+        closing_engine, _engine = _engine, None
+    if closing_engine is not None:
+        closing_engine.close()
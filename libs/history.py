@@ -0,0 +1,496 @@
+"""
+Copyright 2023 laynholt
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import time
+import queue
+import pathlib
+import logging
+import sqlite3
+import threading
+import contextlib
+import concurrent.futures
+
+import config
+
+logger = logging.getLogger(__name__)
+
+
+class KnownTracks:
+    """
+    Множество треков плейлиста, уже записанных в базу истории: id треков и пары (название, исполнитель).
+    Позволяет проверять трек в памяти, не обращаясь к базе.
+    """
+
+    def __init__(self, rows=()):
+        """
+        :param rows: записанные треки (id, название, исполнитель)
+        """
+        self._ids = set()
+        self._keys = set()
+        self._lock = threading.Lock()
+        for track_id, track_name, artist_name in rows:
+            self._ids.add(str(track_id))
+            self._keys.add((track_name, artist_name))
+
+    def __len__(self):
+        return len(self._ids)
+
+    def contains(self, track_id, track_name: str, artist_name: str) -> bool:
+        return str(track_id) in self._ids or (track_name, artist_name) in self._keys
+
+    def add(self, track_id, track_name: str, artist_name: str):
+        with self._lock:
+            self._ids.add(str(track_id))
+            self._keys.add((track_name, artist_name))
+
+
+class HistoryDatabase:
+    """
+    База данных истории загрузок.
+
+    Треки хранятся один раз в таблице tracks (ключ - id трека), а принадлежность трека плейлисту, вместе с кодеком
+    и битрейтом скачанного файла, - в таблице playlist_tracks. Индексы по id и по (название, исполнитель) позволяют
+    проверять трек за O(log n), а не перебором всей таблицы плейлиста.
+    Старые таблицы table_{плейлист} (по одной на плейлист, без индексов) переносятся в новую схему при открытии базы.
+
+    Изменения выполняет один поток записи: они приходят через очередь и фиксируются пачками в одной транзакции
+    (по количеству или по времени), поэтому воркеры не соревнуются за блокировку базы и не ждут fsync на каждый трек.
+    База работает в режиме WAL, и чтение из долгоживущих соединений только для чтения не блокируется записью.
+
+    Для проверки, есть ли трек в плейлисте, множество его треков загружается из базы один раз (см. KnownTracks)
+    и пополняется при добавлении треков, поэтому повторная синхронизация плейлиста не делает запрос на каждый трек.
+    """
+
+    SCHEMA_VERSION = 1
+    LEGACY_TABLE_PREFIX = 'table_'
+
+    TRACK_COLUMNS = ('track_id', 'artist_id', 'album_id', 'track_name', 'artist_name', 'album_name', 'genre',
+                     'track_number', 'disk_number', 'year', 'release_data', 'is_favorite', 'is_explicit', 'is_popular')
+
+    # Маркер завершения потока записи
+    _STOP = object()
+
+    def __init__(self, path: str, batch_size: int = config.HISTORY_WRITE_BATCH_SIZE,
+                 batch_interval: float = config.HISTORY_WRITE_BATCH_INTERVAL,
+                 read_connections: int = config.HISTORY_READ_CONNECTIONS):
+        """
+        :param path: путь к файлу базы данных
+        :param batch_size: максимальное количество изменений в одной транзакции
+        :param batch_interval: максимальное время (в секундах), которое изменение ждёт фиксации
+        :param read_connections: максимальное количество соединений для чтения
+        """
+        self.path = path
+        self._schema_lock = threading.Lock()
+        self._is_schema_ready = False
+
+        self._batch_size = max(1, batch_size)
+        self._batch_interval = batch_interval
+        self._writes = queue.Queue()
+        self._writer = None
+        self._writer_lock = threading.Lock()
+
+        self._readers = queue.LifoQueue()
+        self._readers_semaphore = threading.BoundedSemaphore(max(1, read_connections))
+        self._all_readers = []
+        self._readers_lock = threading.Lock()
+
+        self._known_tracks = {}
+        self._known_tracks_lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        con = sqlite3.connect(self.path)
+        con.execute('PRAGMA journal_mode=WAL')
+        # В режиме WAL синхронизация при каждой фиксации не нужна для целостности базы
+        con.execute('PRAGMA synchronous=NORMAL')
+        return con
+
+    @contextlib.contextmanager
+    def _reader(self):
+        """
+        Выдаёт соединение только для чтения из пула, открывая новое, если свободных нет и лимит не исчерпан
+
+        :return:
+        """
+        self._ensure_schema()
+        with self._readers_semaphore:
+            try:
+                con = self._readers.get_nowait()
+            except queue.Empty:
+                con = sqlite3.connect(f'{pathlib.Path(self.path).absolute().as_uri()}?mode=ro', uri=True,
+                                      check_same_thread=False)
+                with self._readers_lock:
+                    self._all_readers.append(con)
+            try:
+                yield con
+            finally:
+                self._readers.put(con)
+
+    def _write(self, operation) -> concurrent.futures.Future:
+        """
+        Отправляет изменение потоку записи
+
+        :param operation: функция operation(con), выполняющая изменение в переданном соединении
+        :return: future, который завершается после фиксации транзакции с изменением
+        """
+        self._ensure_schema()
+        with self._writer_lock:
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._run_writer, name='ymd-history-writer', daemon=True)
+                self._writer.start()
+
+        future = concurrent.futures.Future()
+        self._writes.put((operation, future))
+        return future
+
+    def _run_writer(self):
+        con = self._connect()
+        # Транзакциями управляет сам поток записи
+        con.isolation_level = None
+        try:
+            while True:
+                item = self._writes.get()
+                if item is self._STOP:
+                    return
+
+                # Набираем пачку изменений, пока она не заполнится или не истечёт время ожидания
+                batch = [item]
+                deadline = time.monotonic() + self._batch_interval
+                is_stopping = False
+                while len(batch) < self._batch_size:
+                    try:
+                        item = self._writes.get(timeout=max(0.0, deadline - time.monotonic()))
+                    except queue.Empty:
+                        break
+                    if item is self._STOP:
+                        is_stopping = True
+                        break
+                    batch.append(item)
+
+                self._commit_batch(con, batch)
+                if is_stopping:
+                    return
+        finally:
+            con.close()
+
+    @staticmethod
+    def _commit_batch(con: sqlite3.Connection, batch):
+        """
+        Выполняет пачку изменений в одной транзакции. Ошибка одного изменения откатывает только его.
+
+        :param con: соединение потока записи
+        :param batch: список (изменение, future)
+        :return:
+        """
+        errors = {}
+        try:
+            con.execute('BEGIN')
+            for operation, future in batch:
+                con.execute('SAVEPOINT operation')
+                try:
+                    operation(con)
+                    con.execute('RELEASE operation')
+                except Exception as e:
+                    con.execute('ROLLBACK TO operation')
+                    con.execute('RELEASE operation')
+                    errors[future] = e
+            con.execute('COMMIT')
+        except sqlite3.Error as e:
+            if con.in_transaction:
+                con.execute('ROLLBACK')
+            logger.error(f'Не удалось зафиксировать изменения в базе данных: {e}')
+            for _, future in batch:
+                future.set_exception(e)
+            return
+
+        for _, future in batch:
+            if future in errors:
+                logger.error(f'Не удалось выполнить изменение в базе данных: {errors[future]}')
+                future.set_exception(errors[future])
+            else:
+                future.set_result(True)
+
+    def flush(self):
+        """
+        Ждёт фиксации всех отправленных изменений
+
+        :return:
+        """
+        if self._writer is None:
+            return
+        self._write(lambda con: None).exception()
+
+    def close(self):
+        """
+        Фиксирует отправленные изменения, завершает поток записи и закрывает соединения для чтения
+
+        :return:
+        """
+        with self._writer_lock:
+            writer, self._writer = self._writer, None
+        if writer is not None:
+            self._writes.put(self._STOP)
+            writer.join()
+
+        with self._readers_lock:
+            readers, self._all_readers = self._all_readers, []
+        for con in readers:
+            con.close()
+        self._readers = queue.LifoQueue()
+
+    def create_schema(self):
+        """
+        Создаёт таблицы и индексы, если их ещё нет, и переносит в них данные из старых таблиц плейлистов
+
+        :return:
+        """
+        with self._schema_lock:
+            con = self._connect()
+            try:
+                with con:
+                    con.execute("CREATE TABLE IF NOT EXISTS tracks("
+                                "track_id TEXT PRIMARY KEY,"
+                                "artist_id TEXT NOT NULL,"
+                                "album_id TEXT,"
+                                "track_name TEXT NOT NULL,"
+                                "artist_name TEXT NOT NULL,"
+                                "album_name TEXT,"
+                                "genre TEXT,"
+                                "track_number INTEGER NOT NULL,"
+                                "disk_number INTEGER NOT NULL,"
+                                "year INTEGER,"
+                                "release_data TEXT,"
+                                "is_favorite INTEGER NOT NULL DEFAULT 0,"
+                                "is_explicit INTEGER NOT NULL DEFAULT 0,"
+                                "is_popular INTEGER NOT NULL DEFAULT 0"
+                                ")")
+                    con.execute("CREATE TABLE IF NOT EXISTS playlist_tracks("
+                                "playlist TEXT NOT NULL,"
+                                "track_id TEXT NOT NULL REFERENCES tracks(track_id),"
+                                "bit_rate INTEGER NOT NULL,"
+                                "codec TEXT NOT NULL,"
+                                "PRIMARY KEY (playlist, track_id)"
+                                ") WITHOUT ROWID")
+                    con.execute("CREATE INDEX IF NOT EXISTS idx_tracks_name_artist ON tracks(track_name, artist_name)")
+                    con.execute("CREATE INDEX IF NOT EXISTS idx_playlist_tracks_track_id ON playlist_tracks(track_id)")
+                    self._migrate_legacy_tables(con)
+                    con.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+            finally:
+                con.close()
+            self._is_schema_ready = True
+
+    def _ensure_schema(self):
+        if not self._is_schema_ready:
+            self.create_schema()
+
+    def _migrate_legacy_tables(self, con: sqlite3.Connection):
+        """
+        Переносит треки из старых таблиц table_{плейлист} в новую схему и удаляет старые таблицы.
+        Выполняется в транзакции вызывающего: при ошибке старые таблицы остаются нетронутыми.
+
+        :param con: соединение с базой данных
+        :return:
+        """
+        legacy_tables = [row[0] for row in con.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name GLOB ?",
+            [f'{self.LEGACY_TABLE_PREFIX}*'])]
+
+        for table_name in legacy_tables:
+            playlist = table_name[len(self.LEGACY_TABLE_PREFIX):]
+            columns = {row[1] for row in con.execute(f'PRAGMA table_info("{table_name}")')}
+            # В старых базах может не быть столбцов, добавленных позже
+            select_columns = ', '.join(column if column in columns else '0' for column in self.TRACK_COLUMNS)
+
+            logger.debug(f'Переношу таблицу [{table_name}] в новую схему базы данных.')
+            con.execute(f'INSERT OR IGNORE INTO tracks({", ".join(self.TRACK_COLUMNS)}) '
+                        f'SELECT {select_columns} FROM "{table_name}"')
+            con.execute(f'INSERT OR IGNORE INTO playlist_tracks(playlist, track_id, bit_rate, codec) '
+                        f'SELECT ?, track_id, bit_rate, codec FROM "{table_name}"', [playlist])
+            con.execute(f'DROP TABLE "{table_name}"')
+
+        if legacy_tables:
+            logger.debug(f'В новую схему базы данных [{self.path}] перенесено таблиц: {len(legacy_tables)}.')
+
+    def contains(self, playlist: str, track_id, track_name: str, artist_name: str) -> bool:
+        """
+        Проверяет, есть ли трек в плейлисте (по id, либо по названию и исполнителю)
+
+        :param playlist: ключ плейлиста
+        :param track_id: id трека
+        :param track_name: название трека
+        :param artist_name: исполнители трека
+        :return:
+        """
+        return self.get_quality(playlist, track_id, track_name, artist_name) is not None
+
+    def get_known_tracks(self, playlist: str) -> KnownTracks:
+        """
+        Множество треков плейлиста. При первом обращении загружается из базы одним запросом.
+
+        :param playlist: ключ плейлиста
+        :return:
+        """
+        with self._known_tracks_lock:
+            known_tracks = self._known_tracks.get(playlist)
+            if known_tracks is None:
+                with self._reader() as con:
+                    known_tracks = KnownTracks(con.execute(
+                        "SELECT tracks.track_id, track_name, artist_name FROM playlist_tracks "
+                        "JOIN tracks ON tracks.track_id = playlist_tracks.track_id "
+                        "WHERE playlist = ?", [playlist]))
+                self._known_tracks[playlist] = known_tracks
+                logger.debug(f'Загружено треков плейлиста [{playlist}] из базы данных: {len(known_tracks)}.')
+            return known_tracks
+
+    def get_quality(self, playlist: str, track_id, track_name: str, artist_name: str):
+        """
+        Кодек и битрейт, с которыми трек записан в плейлисте
+
+        :param playlist: ключ плейлиста
+        :param track_id: id трека
+        :param track_name: название трека
+        :param artist_name: исполнители трека
+        :return: (кодек, битрейт), либо None, если трека нет в плейлисте
+        """
+        with self._reader() as con:
+            return con.execute("SELECT codec, bit_rate FROM playlist_tracks WHERE playlist = ? AND track_id IN ("
+                               "SELECT track_id FROM tracks WHERE track_id = ? "
+                               "OR (track_name = ? AND artist_name = ?)) LIMIT 1",
+                               [playlist, str(track_id), track_name, artist_name]).fetchone()
+
+    def update_quality(self, playlist: str, track_id, track_name: str, artist_name: str, codec: str, bit_rate: int):
+        """
+        Записывает кодек и битрейт скачанного трека
+
+        :param playlist: ключ плейлиста
+        :param track_id: id трека
+        :param track_name: название трека
+        :param artist_name: исполнители трека
+        :param codec: кодек трека
+        :param bit_rate: битрейт трека
+        :return: future фиксации изменения
+        """
+        return self._write(lambda con: con.execute(
+            "UPDATE playlist_tracks SET codec = ?, bit_rate = ? WHERE playlist = ? AND track_id IN ("
+            "SELECT track_id FROM tracks WHERE track_id = ? "
+            "OR (track_name = ? AND artist_name = ?))",
+            [codec, bit_rate, playlist, str(track_id), track_name, artist_name]))
+
+    def add_track(self, playlist: str, track: dict, codec: str, bit_rate: int):
+        """
+        Добавляет трек в плейлист. Метаданные трека, уже записанного из другого плейлиста, обновляются.
+
+        :param playlist: ключ плейлиста
+        :param track: значения столбцов таблицы tracks (TRACK_COLUMNS)
+        :param codec: кодек трека
+        :param bit_rate: битрейт трека
+        :return: future фиксации изменения
+        """
+        return self.add_tracks(playlist, [(track, codec, bit_rate)])
+
+    def add_tracks(self, playlist: str, tracks) -> concurrent.futures.Future:
+        """
+        Добавляет треки в плейлист одним изменением (executemany в одной транзакции)
+
+        :param playlist: ключ плейлиста
+        :param tracks: список (значения столбцов таблицы tracks, кодек, битрейт)
+        :return: future фиксации изменения
+        """
+        track_rows = [[track[column] for column in self.TRACK_COLUMNS] for track, _, _ in tracks]
+        playlist_rows = [(playlist, track['track_id'], bit_rate, codec) for track, codec, bit_rate in tracks]
+
+        # Загруженное множество треков плейлиста пополняется сразу, не дожидаясь фиксации записи
+        with self._known_tracks_lock:
+            known_tracks = self._known_tracks.get(playlist)
+        if known_tracks is not None:
+            for track, _, _ in tracks:
+                known_tracks.add(track['track_id'], track['track_name'], track['artist_name'])
+
+        def _add(con):
+            con.executemany(f"INSERT OR REPLACE INTO tracks({', '.join(self.TRACK_COLUMNS)}) "
+                            f"VALUES({', '.join('?' * len(self.TRACK_COLUMNS))})", track_rows)
+            con.executemany("INSERT OR REPLACE INTO playlist_tracks(playlist, track_id, bit_rate, codec) "
+                            "VALUES(?, ?, ?, ?)", playlist_rows)
+
+        return self._write(_add)
+
+    def update_favorites(self, playlist: str, track_ids, liked_ids) -> concurrent.futures.Future:
+        """
+        Обновляет отметки любимых треков плейлиста одним запросом: трек отмечается любимым, если его id есть
+        среди лайкнутых, иначе отметка снимается. Треки, которых нет в плейлисте в базе, не меняются.
+
+        :param playlist: ключ плейлиста
+        :param track_ids: id треков плейлиста
+        :param liked_ids: множество id лайкнутых треков
+        :return: future фиксации изменения
+        """
+        rows = [(str(track_id), str(track_id) in liked_ids) for track_id in track_ids]
+
+        def _update(con):
+            con.execute("CREATE TEMP TABLE IF NOT EXISTS favorites_update("
+                        "track_id TEXT PRIMARY KEY, is_favorite INTEGER NOT NULL)")
+            con.execute("DELETE FROM favorites_update")
+            con.executemany("INSERT OR IGNORE INTO favorites_update(track_id, is_favorite) VALUES(?, ?)", rows)
+            con.execute("UPDATE tracks SET is_favorite = ("
+                        "SELECT is_favorite FROM favorites_update WHERE favorites_update.track_id = tracks.track_id) "
+                        "WHERE track_id IN ("
+                        "SELECT favorites_update.track_id FROM favorites_update JOIN playlist_tracks "
+                        "ON playlist_tracks.track_id = favorites_update.track_id AND playlist_tracks.playlist = ?)",
+                        [playlist])
+            con.execute("DELETE FROM favorites_update")
+
+        return self._write(_update)
+
+    def set_favorite(self, track_id, is_favorite: bool):
+        """
+        Отмечает трек любимым (или снимает отметку)
+
+        :param track_id: id трека
+        :param is_favorite: любимый ли это трек
+        :return: future фиксации изменения
+        """
+        return self._write(lambda con: con.execute("UPDATE tracks SET is_favorite = ? WHERE track_id = ?",
+                                                   [is_favorite, str(track_id)]))
+
+
+_history_databases = {}
+_history_databases_lock = threading.Lock()
+
+
+def get_history_database(path: str) -> HistoryDatabase:
+    """
+    Возвращает общую для всего процесса базу истории по указанному пути, создавая её при первом обращении
+
+    :param path: путь к файлу базы данных
+    :return:
+    """
+    path = os.path.abspath(path)
+    with _history_databases_lock:
+        if path not in _history_databases:
+            _history_databases[path] = HistoryDatabase(path)
+        return _history_databases[path]
+
+
+def close_history_databases():
+    """
+    Фиксирует несохранённые изменения и закрывает все открытые базы истории (при завершении программы)
+
+    :return:
+    """
+    with _history_databases_lock:
+        databases = list(_history_databases.values())
+    for database in databases:
+        database.close()
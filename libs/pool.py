@@ -0,0 +1,741 @@
+"""
+Copyright 2023 laynholt
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import time
+import itertools
+import threading
+import collections
+import concurrent.futures
+from queue import Queue
+
+
+class TaskQueue(Queue):
+    """
+    Очередь задач для пула воркеров.
+
+    Воркеры блокируются на get() и не тратят процессорное время, пока очередь пуста.
+    Для завершения воркеров в очередь кладётся маркер STOP (по одному на воркер).
+    """
+
+    STOP = None
+
+    def stop(self, number_of_workers: int = 1):
+        """
+        Кладёт в очередь маркеры завершения для воркеров
+
+        :param number_of_workers: количество воркеров, которые нужно разбудить и завершить
+        :return:
+        """
+        for _ in range(number_of_workers):
+            self.put(self.STOP)
+
+    def wait_done(self, timeout=None) -> bool:
+        """
+        Ожидает, пока все задачи в очереди не будут обработаны (аналог join() с таймаутом)
+
+        :param timeout: максимальное время ожидания в секундах (None - без ограничения)
+        :return: True - если все задачи обработаны
+        """
+        with self.all_tasks_done:
+            if self.unfinished_tasks:
+                self.all_tasks_done.wait(timeout)
+            return not self.unfinished_tasks
+
+
+def order_largest_first(items, get_size, small_every: int = 0) -> list:
+    """
+    Упорядочивает задачи по убыванию оценки размера (longest processing time first): большие задачи начинаются
+    раньше и не растягивают хвост загрузки, а маленькие в конце заполняют освободившихся воркеров.
+    Чтобы прогресс не замирал на больших задачах, после каждых small_every больших вставляется самая маленькая.
+
+    :param items: задачи
+    :param get_size: функция оценки размера задачи
+    :param small_every: после скольких больших задач вставлять одну маленькую (0 - не вставлять)
+    :return: список задач в порядке обработки
+    """
+    ordered = sorted(items, key=get_size, reverse=True)
+    if small_every <= 0:
+        return ordered
+
+    result = []
+    left, right = 0, len(ordered) - 1
+    while left <= right:
+        for _ in range(small_every):
+            if left > right:
+                break
+            result.append(ordered[left])
+            left += 1
+        if left <= right:
+            result.append(ordered[right])
+            right -= 1
+    return result
+
+
+class Stage:
+    """
+    Стадия конвейера: ограничение одновременно обрабатываемых элементов и очередь ожидающих.
+    Потоков у стадии нет, её элементы обрабатывает общий пул конвейера.
+    """
+
+    def __init__(self, name: str, handler, number_of_workers: int = 1, queue_size: int = 0, acquire=None,
+                 release=None):
+        """
+        :param name: название стадии (для логов и имён потоков)
+        :param handler: функция обработки элемента. True - передать элемент дальше, False - обработка завершена
+        :param number_of_workers: сколько элементов стадия обрабатывает одновременно
+        :param queue_size: сколько элементов может ждать обработки в стадии (0 - без ограничения)
+        :param acquire: функция без аргументов, которая блокируется, пока стадии не разрешат обработать ещё
+                        один элемент (например, слот контроллера). False - разрешения не будет (None - без неё)
+        :param release: функция без аргументов, возвращающая разрешение, полученное через acquire
+        """
+        self.name = name
+        self.handler = handler
+        self.number_of_workers = number_of_workers
+        self.queue_size = queue_size
+        self.acquire = acquire
+        self.release = release
+        self.next_stage = None
+
+        self.waiting = collections.deque()
+        self.running = 0
+        self.thread = None
+
+
+class Pipeline:
+    """
+    Конвейер из стадий.
+
+    Элементы всех стадий обрабатываются в общем пуле потоков (executor), а каждая стадия ограничивает только
+    количество своих одновременно обрабатываемых элементов. Поэтому конвейер не создаёт потоков на каждую стадию,
+    и несколько конвейеров (вкладок) делят один пул. Стадия с функцией acquire получает собственный поток,
+    который ждёт разрешения, чтобы потоки пула не простаивали в ожидании.
+    Если в конвейере уже столько элементов, сколько вмещают все стадии, то put() блокируется.
+    Когда элемент покидает конвейер (дошёл до конца, был отброшен или упал с ошибкой), вызывается on_done.
+    """
+
+    def __init__(self, stages, on_done, executor: concurrent.futures.Executor):
+        """
+        :param stages: список стадий в порядке обработки
+        :param on_done: функция on_done(item, error), вызывается для каждого вышедшего из конвейера элемента
+        :param executor: пул потоков, в котором обрабатываются элементы
+        """
+        self._stages = stages
+        self._on_done = on_done
+        self._executor = executor
+
+        for stage, next_stage in zip(stages, stages[1:]):
+            stage.next_stage = next_stage
+
+        if all(stage.queue_size > 0 for stage in stages):
+            self._capacity = sum(stage.number_of_workers + stage.queue_size for stage in stages)
+        else:
+            self._capacity = None
+        self._items = 0
+
+        self._is_cancelled = False
+        self._is_paused = False
+        self._is_closed = False
+        self._condition = threading.Condition()
+
+    def start(self):
+        """
+        Запускает потоки стадий, которые ждут разрешения на обработку
+
+        :return:
+        """
+        for stage in self._stages:
+            if stage.acquire is not None:
+                stage.thread = threading.Thread(target=self._run_gate, args=[stage], name=f'{stage.name}-gate',
+                                                daemon=True)
+                stage.thread.start()
+
+    def put(self, item) -> bool:
+        """
+        Отправляет элемент в первую стадию конвейера (блокируется, если конвейер заполнен)
+
+        :param item: элемент
+        :return: False - если конвейер уже отменён и элемент не был принят
+        """
+        with self._condition:
+            while not self._is_cancelled and self._capacity is not None and self._items >= self._capacity:
+                self._condition.wait()
+            if self._is_cancelled:
+                return False
+            self._items += 1
+        self._enter(self._stages[0], item)
+        return True
+
+    def pause(self):
+        with self._condition:
+            self._is_paused = True
+
+    def resume(self):
+        with self._condition:
+            self._is_paused = False
+            self._condition.notify_all()
+        for stage in self._stages:
+            self._dispatch(stage)
+
+    def cancel(self):
+        """
+        Отменяет обработку: стадии перестают обрабатывать элементы и просто выпускают их из конвейера
+
+        :return:
+        """
+        with self._condition:
+            self._is_cancelled = True
+            self._condition.notify_all()
+        self.resume()
+
+    def is_cancelled(self) -> bool:
+        return self._is_cancelled
+
+    def close(self):
+        """
+        Дожидается, пока все элементы покинут конвейер, и останавливает потоки стадий
+
+        :return:
+        """
+        with self._condition:
+            while self._items:
+                self._condition.wait()
+            self._is_closed = True
+            self._condition.notify_all()
+
+        for stage in self._stages:
+            if stage.thread is not None:
+                stage.thread.join()
+
+    def _enter(self, stage, item):
+        with self._condition:
+            stage.waiting.append(item)
+            self._condition.notify_all()
+        self._dispatch(stage)
+
+    def _dispatch(self, stage):
+        # Стадию с разрешениями обслуживает её поток, остальные элементы сразу отправляются в пул
+        if stage.acquire is not None:
+            return
+
+        with self._condition:
+            while not self._is_paused and stage.waiting and stage.running < stage.number_of_workers:
+                item = stage.waiting.popleft()
+                stage.running += 1
+                self._executor.submit(self._run, stage, item, False)
+
+    def _run_gate(self, stage):
+        while True:
+            with self._condition:
+                while not self._is_closed and \
+                        (self._is_paused or not stage.waiting or stage.running >= stage.number_of_workers):
+                    self._condition.wait()
+                if self._is_closed:
+                    return
+                item = stage.waiting.popleft()
+                stage.running += 1
+
+            # Отменённый элемент разрешения не ждёт, а сразу выходит из конвейера
+            is_permitted = not self._is_cancelled and stage.acquire()
+            self._executor.submit(self._run, stage, item, is_permitted)
+
+    def _run(self, stage, item, is_permitted):
+        try:
+            if self._is_cancelled or stage.acquire is not None and not is_permitted:
+                self._finish(item, None)
+                return
+
+            try:
+                is_passed = stage.handler(item)
+            except Exception as e:
+                self._finish(item, e)
+                return
+
+            if is_passed and stage.next_stage is not None:
+                self._enter(stage.next_stage, item)
+            else:
+                self._finish(item, None)
+        finally:
+            if is_permitted:
+                stage.release()
+            with self._condition:
+                stage.running -= 1
+                self._condition.notify_all()
+            self._dispatch(stage)
+
+    def _finish(self, item, error):
+        try:
+            self._on_done(item, error)
+        finally:
+            with self._condition:
+                self._items -= 1
+                self._condition.notify_all()
+
+
+class AimdController:
+    """
+    Адаптивный ограничитель параллельности по принципу AIMD (аддитивное увеличение, мультипликативное уменьшение).
+
+    Воркеры берут слот через acquire() перед обработкой задачи и возвращают его через release(). О каждой
+    настоящей загрузке сообщается в record() (длительность и размер), об ошибках - в record_failure(); задачи без
+    загрузки (трек уже в истории или на диске) не учитываются. Раз в окно контроллер оценивает пропускную способность
+    в байтах, задержку на байт и долю ошибок: если ошибок много или задержка на байт выросла относительно базовой,
+    лимит уменьшается в разы, иначе, пока пропускная способность не падает, лимит увеличивается на единицу.
+    Базовая задержка - лучшая из недавних: при росте задержки она постепенно подтягивается к текущей, поэтому
+    одно удачное окно не занижает лимит навсегда.
+    """
+
+    def __init__(self, initial: int, minimum: int = 1, maximum: int = None, window: float = 5.0,
+                 error_rate_threshold: float = 0.1, latency_factor: float = 2.0, decrease_factor: float = 0.5,
+                 baseline_decay: float = 0.2):
+        """
+        :param initial: начальный лимит
+        :param minimum: минимальный лимит
+        :param maximum: максимальный лимит (None - равен начальному, то есть лимит фиксированный)
+        :param window: длительность окна наблюдения в секундах
+        :param error_rate_threshold: доля ошибок в окне, при превышении которой лимит уменьшается
+        :param latency_factor: во сколько раз задержка на байт должна превысить базовую, чтобы лимит уменьшился
+        :param decrease_factor: множитель уменьшения лимита
+        :param baseline_decay: доля, на которую базовая задержка за окно приближается к выросшей текущей
+        """
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, initial if maximum is None else maximum)
+        self._limit = min(max(initial, self.minimum), self.maximum)
+
+        self._window = window
+        self._error_rate_threshold = error_rate_threshold
+        self._latency_factor = latency_factor
+        self._decrease_factor = decrease_factor
+        self._baseline_decay = baseline_decay
+
+        self._active = 0
+        self._is_closed = False
+        self._condition = threading.Condition()
+
+        self._window_start = time.monotonic()
+        self._transfers = 0
+        self._failures = 0
+        self._bytes = 0
+        self._latency_sum = 0.0
+        self._previous_throughput = 0.0
+        self._baseline_latency = None
+
+    @property
+    def limit(self) -> int:
+        return self._limit
+
+    @property
+    def active(self) -> int:
+        return self._active
+
+    def is_adaptive(self) -> bool:
+        return self.minimum != self.maximum
+
+    def acquire(self) -> bool:
+        """
+        Занимает слот, блокируясь, пока количество активных задач не меньше лимита
+
+        :return: False - если контроллер закрыт
+        """
+        with self._condition:
+            while self._active >= self._limit and not self._is_closed:
+                self._condition.wait()
+            if self._is_closed:
+                return False
+            self._active += 1
+            return True
+
+    def try_acquire(self) -> bool:
+        """
+        Занимает слот, только если он свободен, не блокируясь
+
+        :return: True - если слот занят
+        """
+        with self._condition:
+            if self._is_closed or self._active >= self._limit:
+                return False
+            self._active += 1
+            return True
+
+    def release(self):
+        """
+        Освобождает слот
+
+        :return:
+        """
+        with self._condition:
+            self._active -= 1
+            self._condition.notify()
+
+    def record(self, latency: float, size: int = 0, is_success: bool = True):
+        """
+        Учитывает результат загрузки и, если окно закончилось, пересчитывает лимит
+
+        :param latency: длительность загрузки в секундах
+        :param size: количество загруженных байт
+        :param is_success: загрузка выполнена без ошибок
+        :return:
+        """
+        with self._condition:
+            if not is_success:
+                self._failures += 1
+            elif size > 0:
+                self._transfers += 1
+                self._bytes += size
+                self._latency_sum += latency
+
+            now = time.monotonic()
+            if self.is_adaptive() and now - self._window_start >= self._window:
+                self._adjust(now)
+
+    def record_failure(self):
+        """
+        Учитывает неудачный запрос (например, повторённый из-за временной ошибки)
+
+        :return:
+        """
+        self.record(0.0, is_success=False)
+
+    def close(self):
+        """
+        Будит всех ожидающих слот, после чего acquire() возвращает False
+
+        :return:
+        """
+        with self._condition:
+            self._is_closed = True
+            self._condition.notify_all()
+
+    def _adjust(self, now):
+        samples = self._transfers + self._failures
+        throughput = self._bytes / (now - self._window_start)
+        error_rate = self._failures / samples if samples else 0.0
+        # Задержка на байт по всему окну, чтобы большие и маленькие файлы были сравнимы
+        byte_latency = self._latency_sum / self._bytes if self._bytes else None
+
+        is_latency_grown = byte_latency is not None and self._baseline_latency is not None and \
+            byte_latency > self._baseline_latency * self._latency_factor
+
+        if byte_latency is not None:
+            if self._baseline_latency is None or byte_latency < self._baseline_latency:
+                self._baseline_latency = byte_latency
+            else:
+                self._baseline_latency += (byte_latency - self._baseline_latency) * self._baseline_decay
+
+        new_limit = self._limit
+        if error_rate > self._error_rate_threshold or is_latency_grown:
+            new_limit = max(self.minimum, int(self._limit * self._decrease_factor))
+        elif throughput >= self._previous_throughput * 0.95:
+            new_limit = min(self.maximum, self._limit + 1)
+
+        if new_limit != self._limit:
+            self._limit = new_limit
+            self._condition.notify_all()
+
+        self._previous_throughput = throughput
+        self._window_start = now
+        self._transfers = 0
+        self._failures = 0
+        self._bytes = 0
+        self._latency_sum = 0.0
+
+
+class Prefetcher:
+    """
+    Заранее выполняет запросы для следующих задач очереди.
+
+    Задачи регистрируются через add() в порядке очереди, и для первых lookahead из них запросы выполняются
+    в отдельном пуле потоков. Воркер забирает готовый результат через get(), после чего запрос выполняется
+    для следующей задачи. Результаты старше ttl считаются устаревшими (например, истекли подписанные ссылки)
+    и запрашиваются заново.
+    """
+
+    def __init__(self, resolve, lookahead: int = 16, ttl: float = 60.0, number_of_workers: int = 4):
+        """
+        :param resolve: функция запроса resolve(*args)
+        :param lookahead: количество задач, для которых результат запрашивается заранее
+        :param ttl: время жизни результата в секундах
+        :param number_of_workers: количество потоков для запросов
+        """
+        self._resolve = resolve
+        self._lookahead = lookahead
+        self._ttl = ttl
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=number_of_workers,
+                                                               thread_name_prefix='ymd-prefetch')
+        self._pending = collections.OrderedDict()
+        # key -> (future, время постановки в пул)
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._is_closed = False
+
+    def add(self, key, *args):
+        """
+        Регистрирует задачу в порядке очереди
+
+        :param key: ключ задачи
+        :param args: аргументы функции запроса
+        :return:
+        """
+        with self._lock:
+            self._pending[key] = args
+            self._fill()
+
+    def get(self, key, *args):
+        """
+        Возвращает результат запроса для задачи. Если он не был получен заранее или устарел, то выполняет запрос сразу.
+
+        :param key: ключ задачи
+        :param args: аргументы функции запроса
+        :return: результат функции запроса
+        """
+        with self._lock:
+            self._pending.pop(key, None)
+            entry = self._entries.pop(key, None)
+            self._fill()
+
+        if entry is not None:
+            future, _ = entry
+            try:
+                resolved_at, result = future.result()
+                if time.monotonic() - resolved_at < self._ttl:
+                    return result
+            except Exception:
+                # Ошибку (или отмену) заранее выполненного запроса не пробрасываем, а повторяем запрос в потоке воркера
+                pass
+        return self._resolve(*args)
+
+    def discard(self, key):
+        """
+        Удаляет задачу, результат для которой уже не понадобится
+
+        :param key: ключ задачи
+        :return:
+        """
+        with self._lock:
+            self._pending.pop(key, None)
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                entry[0].cancel()
+            self._fill()
+
+    def close(self):
+        with self._lock:
+            self._is_closed = True
+            self._pending.clear()
+            for future, _ in self._entries.values():
+                future.cancel()
+            self._entries.clear()
+        self._executor.shutdown(wait=False)
+
+    def _fill(self):
+        if self._is_closed:
+            return
+
+        # Результаты, которые так и не забрали, освобождают место по истечении времени жизни
+        now = time.monotonic()
+        for key in [key for key, (future, created_at) in self._entries.items()
+                    if future.done() and now - created_at >= self._ttl]:
+            del self._entries[key]
+
+        while self._pending and len(self._entries) < self._lookahead:
+            key, args = self._pending.popitem(last=False)
+            self._entries[key] = (self._executor.submit(self._timed_resolve, *args), now)
+
+    def _timed_resolve(self, *args):
+        result = self._resolve(*args)
+        return time.monotonic(), result
+
+
+class FairScheduler:
+    """
+    Общий для всех вкладок ограничитель количества одновременно обрабатываемых задач со взвешенной честной
+    очередью (weighted fair queuing).
+
+    Каждая вкладка регистрируется как задание с весом (приоритетом). Когда освобождается слот, его получает
+    ожидающее задание с наименьшим виртуальным временем: каждый полученный слот увеличивает его на 1 / вес,
+    поэтому при нехватке слотов задания получают их пропорционально весам, а новая вкладка не ждёт, пока
+    старые разберут свои очереди. Суммарно слотов не больше общего ограничения, сколько бы вкладок ни было запущено.
+    Ограничение 0 означает, что слоты не ограничены и задания получают их сразу.
+    """
+
+    class Job:
+        def __init__(self, scheduler, weight, number):
+            self._scheduler = scheduler
+            self.weight = max(1, weight)
+            self.number = number
+            self.virtual_time = 0.0
+            self.waiting = 0
+            self.active = 0
+            self.is_closed = False
+
+        @property
+        def limit(self) -> int:
+            return self._scheduler.limit
+
+        def set_weight(self, weight: int):
+            self.weight = max(1, weight)
+
+        def acquire(self) -> bool:
+            """
+            Занимает слот, блокируясь, пока не подойдёт очередь задания
+
+            :return: False - если задание закрыто
+            """
+            return self._scheduler.acquire(self)
+
+        def try_acquire(self) -> bool:
+            """
+            Занимает слот без ожидания, если он свободен и его не ждут другие задания
+
+            :return: True - если слот занят
+            """
+            return self._scheduler.try_acquire(self)
+
+        def release(self):
+            self._scheduler.release(self)
+
+        def close(self):
+            """
+            Снимает задание с планировщика. Ожидающие слот получают False.
+
+            :return:
+            """
+            self._scheduler.remove_job(self)
+
+    def __init__(self, limit: int):
+        """
+        :param limit: общее ограничение количества одновременно обрабатываемых задач (0 - без ограничения)
+        """
+        self.limit = max(0, limit)
+        self._active = 0
+        self._jobs = []
+        self._virtual_time = 0.0
+        self._numbers = itertools.count()
+        self._condition = threading.Condition()
+
+    @property
+    def active(self) -> int:
+        return self._active
+
+    def create_job(self, weight: int = 1) -> Job:
+        job = self.Job(self, weight, next(self._numbers))
+        with self._condition:
+            self._jobs.append(job)
+        return job
+
+    def remove_job(self, job: Job):
+        with self._condition:
+            job.is_closed = True
+            if job in self._jobs:
+                self._jobs.remove(job)
+            self._condition.notify_all()
+
+    def acquire(self, job: Job) -> bool:
+        with self._condition:
+            if job.waiting == 0:
+                # Простаивавшее задание не накапливает право на слоты, а встаёт в очередь с текущего момента
+                job.virtual_time = max(job.virtual_time, self._virtual_time)
+            job.waiting += 1
+            try:
+                while not job.is_closed and not (self._has_free_slot() and self._get_next_job() is job):
+                    self._condition.wait()
+            finally:
+                job.waiting -= 1
+
+            if job.is_closed:
+                return False
+
+            self._active += 1
+            job.active += 1
+            self._virtual_time = job.virtual_time
+            job.virtual_time += 1 / job.weight
+            # Слоты могут остаться, и тогда очередь подходит следующему заданию
+            self._condition.notify_all()
+            return True
+
+    def try_acquire(self, job: Job) -> bool:
+        with self._condition:
+            if job.is_closed or not self._has_free_slot() or self._get_next_job() is not None:
+                return False
+            self._active += 1
+            job.active += 1
+            job.virtual_time = max(job.virtual_time, self._virtual_time) + 1 / job.weight
+            return True
+
+    def release(self, job: Job):
+        with self._condition:
+            self._active -= 1
+            job.active -= 1
+            self._condition.notify_all()
+
+    def _has_free_slot(self) -> bool:
+        return not self.limit or self._active < self.limit
+
+    def _get_next_job(self):
+        waiting_jobs = [job for job in self._jobs if job.waiting]
+        if not waiting_jobs:
+            return None
+        return min(waiting_jobs, key=lambda job: (job.virtual_time, job.number))
+
+
+_worker_pools = {}
+_worker_pools_lock = threading.Lock()
+
+
+def get_worker_pool(name: str, number_of_workers: int) -> concurrent.futures.ThreadPoolExecutor:
+    """
+    Возвращает общий для всего процесса пул потоков движка, создавая его при первом обращении.
+    Вкладки не создают своих потоков, а отправляют задачи в этот пул.
+
+    :param name: название движка загрузки, у каждого движка свой пул
+    :param number_of_workers: количество потоков пула
+    :return:
+    """
+    with _worker_pools_lock:
+        if name not in _worker_pools:
+            _worker_pools[name] = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, number_of_workers),
+                                                                        thread_name_prefix=f'ymd-pool-{name}')
+        return _worker_pools[name]
+
+
+def close_worker_pools():
+    """
+    Останавливает все общие пулы потоков (при завершении программы)
+
+    :return:
+    """
+    with _worker_pools_lock:
+        worker_pools = list(_worker_pools.values())
+        _worker_pools.clear()
+    for worker_pool in worker_pools:
+        worker_pool.shutdown(wait=False)
+
+
+_fair_schedulers = {}
+_fair_scheduler_lock = threading.Lock()
+
+
+def get_fair_scheduler(name: str, limit: int) -> FairScheduler:
+    """
+    Возвращает общий для всего процесса планировщик движка, создавая его при первом обращении
+
+    :param name: название движка загрузки, у каждого движка свой планировщик
+    :param limit: общее ограничение количества одновременно обрабатываемых задач (0 - без ограничения)
+    :return:
+    """
+    with _fair_scheduler_lock:
+        if name not in _fair_schedulers:
+            _fair_schedulers[name] = FairScheduler(limit)
+        return _fair_schedulers[name]
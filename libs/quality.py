@@ -0,0 +1,97 @@
+"""
+Copyright 2023 laynholt
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import config
+
+
+class QualityPolicy:
+    """
+    Политика выбора варианта загрузки трека (кодек и битрейт).
+
+    Варианты с битрейтом не выше максимального идут первыми, в порядке отступления: 'bitrate' - от лучшего
+    битрейта к худшему, а среди равных по битрейту - по порядку предпочитаемых кодеков; 'codec' - сначала все
+    битрейты первого предпочитаемого кодека, затем следующего. Варианты выше максимального битрейта остаются
+    запасными (от ближайшего к ограничению), чтобы трек всё равно был скачан, если других вариантов нет.
+    """
+
+    FALLBACK_BITRATE = 'bitrate'
+    FALLBACK_CODEC = 'codec'
+
+    def __init__(self, codecs=None, max_bitrate: int = 0, fallback: str = FALLBACK_BITRATE):
+        """
+        :param codecs: предпочитаемые кодеки по порядку (None или [] - любой)
+        :param max_bitrate: максимальный битрейт в кбит/с (0 - без ограничения)
+        :param fallback: порядок отступления 'bitrate' или 'codec'
+        """
+        if fallback not in (self.FALLBACK_BITRATE, self.FALLBACK_CODEC):
+            raise ValueError(f'Неизвестный порядок отступления [{fallback}].')
+
+        self.codecs = [codec.lower() for codec in codecs] if codecs else []
+        self.max_bitrate = max_bitrate or 0
+        self.fallback = fallback
+
+    @classmethod
+    def for_playlist(cls, playlist_title: str):
+        """
+        Политика для плейлиста: общая политика из config.QUALITY_POLICY, дополненная настройками плейлиста
+        из config.PLAYLIST_QUALITY_POLICIES
+
+        :param playlist_title: название плейлиста
+        :return:
+        """
+        settings = dict(config.QUALITY_POLICY)
+        settings.update(config.PLAYLIST_QUALITY_POLICIES.get(playlist_title, {}))
+        return cls(**settings)
+
+    def get_key(self, codec: str, bitrate: int):
+        """
+        Ключ сортировки варианта загрузки: чем меньше, тем вариант предпочтительнее
+
+        :param codec: кодек
+        :param bitrate: битрейт в кбит/с
+        :return:
+        """
+        bitrate = bitrate or 0
+        codec = (codec or '').lower()
+
+        is_exceeding = self.max_bitrate > 0 and bitrate > self.max_bitrate
+        # Среди вариантов выше ограничения предпочитаем ближайший к нему
+        bitrate_key = bitrate if is_exceeding else -bitrate
+        codec_key = self.codecs.index(codec) if codec in self.codecs else len(self.codecs)
+
+        if self.fallback == self.FALLBACK_CODEC:
+            return is_exceeding, codec_key, bitrate_key
+        return is_exceeding, bitrate_key, codec_key
+
+    def order(self, download_info) -> list:
+        """
+        Упорядочивает варианты загрузки трека от предпочтительного к запасным
+
+        :param download_info: варианты загрузки (yandex_music.DownloadInfo)
+        :return:
+        """
+        return sorted(download_info, key=lambda info: self.get_key(info.codec, info.bitrate_in_kbps))
+
+    def is_better(self, info, codec: str, bitrate: int) -> bool:
+        """
+        Проверяет, предпочтительнее ли вариант загрузки уже скачанного трека с указанными кодеком и битрейтом
+
+        :param info: вариант загрузки (yandex_music.DownloadInfo)
+        :param codec: кодек скачанного трека
+        :param bitrate: битрейт скачанного трека
+        :return:
+        """
+        return self.get_key(info.codec, info.bitrate_in_kbps) < self.get_key(codec, bitrate)
@@ -0,0 +1,147 @@
+"""
+Copyright 2023 laynholt
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import errno
+import shutil
+import logging
+import threading
+import contextlib
+
+import config
+from libs import network
+
+logger = logging.getLogger(__name__)
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: клонирование файлов (reflink) недоступно, используются жёсткие ссылки
+    fcntl = None
+
+# ioctl клонирования файла в Linux (btrfs, xfs и другие файловые системы с copy-on-write)
+_FICLONE = 0x40049409
+
+
+class ContentStore:
+    """
+    Общее хранилище аудио, адресуемое по id трека, кодеку и битрейту.
+
+    Каждый вариант трека скачивается в хранилище один раз, а в папки плейлистов попадают жёсткие ссылки
+    (или клоны reflink, если их поддерживает файловая система) на файл из хранилища. Поэтому плейлист,
+    пересекающийся с уже скачанной библиотекой, не требует загрузки и не занимает место на диске.
+    Хранилище лежит внутри папки загрузки, так как жёсткие ссылки работают только в пределах одного диска.
+    """
+
+    HARDLINK = 'hardlink'
+    REFLINK = 'reflink'
+
+    def __init__(self, path: str, link_mode: str = config.CONTENT_STORE_LINK_MODE):
+        """
+        :param path: путь к папке хранилища
+        :param link_mode: 'hardlink' - жёсткие ссылки, 'reflink' - клоны (если не поддерживаются, то жёсткие ссылки)
+        """
+        if link_mode not in (self.HARDLINK, self.REFLINK):
+            raise ValueError(f'Неизвестный способ связывания файлов [{link_mode}].')
+
+        self.path = path
+        self._link_mode = link_mode
+        os.makedirs(path, exist_ok=True)
+
+        # Жёсткие ссылки указывают на один и тот же файл, поэтому теги в него пишутся по очереди
+        self._file_locks = [threading.Lock() for _ in range(64)]
+
+    def get_filename(self, track_id, codec: str, bitrate: int) -> str:
+        """
+        Путь к варианту трека в хранилище
+
+        :param track_id: id трека
+        :param codec: кодек
+        :param bitrate: битрейт
+        :return:
+        """
+        return os.path.abspath(f'{self.path}/{track_id}.{bitrate}.{codec}')
+
+    def link(self, store_filename: str, filename: str):
+        """
+        Создаёт в папке плейлиста ссылку на файл из хранилища. Существующий файл атомарно заменяется.
+        Если не удалось создать ни клон, ни жёсткую ссылку (например, файловая система их не поддерживает),
+        то файл копируется.
+
+        :param store_filename: путь к файлу в хранилище
+        :param filename: итоговый путь к файлу
+        :return:
+        """
+        if os.path.exists(filename) and os.path.samefile(store_filename, filename):
+            return
+
+        part_filename = network.get_part_filename(filename, 'link')
+        if os.path.exists(part_filename):
+            os.remove(part_filename)
+
+        if not (self._link_mode == self.REFLINK and self._reflink(store_filename, part_filename)):
+            try:
+                os.link(store_filename, part_filename)
+            except OSError as e:
+                logger.debug(f'Не удалось создать жёсткую ссылку на [{store_filename}] ({e}), копирую файл.')
+                shutil.copyfile(store_filename, part_filename)
+        os.replace(part_filename, filename)
+
+    @contextlib.contextmanager
+    def lock(self, filename: str):
+        """
+        Блокирует файл на время записи тегов. Ссылки на один файл хранилища блокируются одной блокировкой.
+
+        :param filename: путь к файлу
+        :return:
+        """
+        stat = os.stat(filename)
+        with self._file_locks[hash((stat.st_dev, stat.st_ino)) % len(self._file_locks)]:
+            yield
+
+    @staticmethod
+    def _reflink(source: str, destination: str) -> bool:
+        if fcntl is None:
+            return False
+
+        try:
+            with open(source, 'rb') as source_file, open(destination, 'wb') as destination_file:
+                fcntl.ioctl(destination_file.fileno(), _FICLONE, source_file.fileno())
+            return True
+        except OSError as e:
+            if os.path.exists(destination):
+                os.remove(destination)
+            if e.errno not in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL, errno.ENOSYS):
+                raise
+            return False
+
+
+_content_stores = {}
+_content_stores_lock = threading.Lock()
+
+
+def get_content_store(path: str) -> ContentStore:
+    """
+    Возвращает общее для всего процесса хранилище по указанному пути, создавая его при первом обращении
+
+    :param path: путь к папке хранилища
+    :return:
+    """
+    path = os.path.abspath(path)
+    with _content_stores_lock:
+        if path not in _content_stores:
+            _content_stores[path] = ContentStore(path)
+        return _content_stores[path]
@@ -18,7 +18,7 @@ import random
 import tkinter
 from tkinter import ttk
 from typing import Any
-from config import Color, paths
+from config import Color, paths, BANDWIDTH_DEFAULT_WEIGHT, DEFAULT_TAB_PRIORITY
 
 import enum
 from math import ceil
@@ -505,6 +505,27 @@ class DownloadInfo(Widget):
         self.finish_downloading = tkinter.BooleanVar(value=False)
         self.finish_downloading.trace_add('write', self._finish_download)
 
+        self.concurrency_value = tkinter.IntVar(value=0)
+        self.concurrency_value.trace_add('write', self._show_statistics)
+
+        self.service_available = tkinter.BooleanVar(value=True)
+        self.service_available.trace_add('write', self._show_loading_state)
+
+        self.stalls_value = tkinter.IntVar(value=0)
+        self.stalls_value.trace_add('write', self._show_statistics)
+
+        self.http_requests_value = tkinter.IntVar(value=0)
+        self.http_requests_value.trace_add('write', self._show_statistics)
+
+        self.http_reused_value = tkinter.IntVar(value=0)
+        self.http_reused_value.trace_add('write', self._show_statistics)
+
+        # Общее ограничение скорости (КБ/с, 0 - без ограничения) и вес вкладки, читаются потоком загрузки
+        self.bandwidth_limit_value = tkinter.IntVar(value=0)
+        self.bandwidth_weight_value = tkinter.IntVar(value=BANDWIDTH_DEFAULT_WEIGHT)
+        # Приоритет вкладки в общем для всех вкладок ограничении одновременных задач
+        self.priority_value = tkinter.IntVar(value=DEFAULT_TAB_PRIORITY)
+
         self._loading_counter = 0
         self.label_downloading = ttk.Label(self.label_frame, text='Идёт загрузка')
         self.label_downloading.pack()
@@ -516,6 +537,33 @@ class DownloadInfo(Widget):
         self._label_failed = ttk.Label(self.label_frame, text='Не получилось выполнить для 0 композиции(-ий)')
         self._label_failed.pack()
 
+        self._label_concurrency = ttk.Label(self.label_frame, text='Одновременных загрузок: 0')
+        self._label_concurrency.pack()
+
+        self._label_stalls = ttk.Label(self.label_frame, text='Перезапущено зависших загрузок: 0')
+        self._label_stalls.pack()
+
+        self._label_http = ttk.Label(self.label_frame, text='HTTP запросов: 0, через открытые соединения: 0')
+        self._label_http.pack()
+
+        self._frame_bandwidth = ttk.Frame(self.label_frame)
+        self._frame_bandwidth.pack(pady=5)
+
+        ttk.Label(self._frame_bandwidth, text='Ограничение скорости (КБ/с, 0 - нет):').grid(row=0, column=0, sticky='w')
+        self._spinbox_bandwidth_limit = ttk.Spinbox(self._frame_bandwidth, from_=0, to=1000000, increment=128,
+                                                    width=8, textvariable=self.bandwidth_limit_value)
+        self._spinbox_bandwidth_limit.grid(row=0, column=1, padx=5)
+
+        ttk.Label(self._frame_bandwidth, text='Доля вкладки:').grid(row=1, column=0, sticky='w')
+        self._spinbox_bandwidth_weight = ttk.Spinbox(self._frame_bandwidth, from_=1, to=100, increment=1,
+                                                     width=8, textvariable=self.bandwidth_weight_value)
+        self._spinbox_bandwidth_weight.grid(row=1, column=1, padx=5)
+
+        ttk.Label(self._frame_bandwidth, text='Приоритет вкладки:').grid(row=2, column=0, sticky='w')
+        self._spinbox_priority = ttk.Spinbox(self._frame_bandwidth, from_=1, to=100, increment=1,
+                                             width=8, textvariable=self.priority_value)
+        self._spinbox_priority.grid(row=2, column=1, padx=5)
+
     def _show_result(self, *args):
         try:
             self._label_successful.config(text=f'Успешно выполнено для {self.successful_download_value.get()} композиции(-ий)')
@@ -523,17 +571,37 @@ class DownloadInfo(Widget):
         except tkinter.TclError:
             pass
 
+    def _show_statistics(self, *args):
+        try:
+            self._label_concurrency.config(text=f'Одновременных загрузок: {self.concurrency_value.get()}')
+            self._label_stalls.config(text=f'Перезапущено зависших загрузок: {self.stalls_value.get()}')
+            self._label_http.config(text=f'HTTP запросов: {self.http_requests_value.get()}, '
+                                         f'через открытые соединения: {self.http_reused_value.get()}')
+        except tkinter.TclError:
+            pass
+
     def _finish_download(self, *args):
         try:
             self.label_downloading.config(text='Загрузка завершена.')
         except tkinter.TclError:
             pass
 
+    def _show_loading_state(self, *args):
+        try:
+            if self.finish_downloading.get() is True:
+                return
+            if self.service_available.get() is False:
+                self.label_downloading.config(text=f'Сервис недоступен, ожидание{"." * self._loading_counter}')
+            else:
+                self.label_downloading.config(text=f'Идёт загрузка{"." * self._loading_counter}')
+        except tkinter.TclError:
+            pass
+
     def _simulate_loading(self, *args):
         try:
             if self.finish_downloading.get() is False:
                 self._loading_counter = (self._loading_counter + 1) % 4
-                self.label_downloading.config(text=f'Идёт загрузка{"." * self._loading_counter}')
+                self._show_loading_state()
                 self.after(1000, self._simulate_loading)
         except tkinter.TclError:
             pass
@@ -542,7 +610,15 @@ class DownloadInfo(Widget):
         return {
                    'successful_download': self.successful_download_value,
                    'failed_download': self.failed_download_value,
-                   'end': self.finish_downloading
+                   'end': self.finish_downloading,
+                   'concurrency': self.concurrency_value,
+                   'service_available': self.service_available,
+                   'stalls': self.stalls_value,
+                   'http_requests': self.http_requests_value,
+                   'http_reused': self.http_reused_value,
+                   'bandwidth_limit': self.bandwidth_limit_value,
+                   'bandwidth_weight': self.bandwidth_weight_value,
+                   'priority': self.priority_value
         }
     
 
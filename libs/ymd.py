@@ -22,14 +22,17 @@ import json
 import sqlite3
 import asyncio
 import threading
+import time
 import webbrowser
+import functools
+import contextlib
+import concurrent.futures
 from enum import auto
 from strenum import StrEnum
 from operator import itemgetter
 from queue import Queue
 from PIL import Image, ImageTk, ImageDraw
 
-import time
 import copy
 
 from mutagen import File
@@ -39,7 +42,7 @@ from yandex_music import Client
 from yandex_music.exceptions import YandexMusicError, UnauthorizedError, NetworkError
 
 import config
-from libs import utils, session, widgets
+from libs import utils, session, widgets, pool, engine, network, quality, store, history
 from . import __github__, __version__, __data__
 
 import logging.config
@@ -710,12 +713,21 @@ class YandexMusicDownloader:
                 if _thread is main_thread:
                     logger.debug(f'Основной поток [{main_thread.ident}] ожидает завершения всех дочерних.')
                     continue
+                # Потоки общих пулов (асинхронного движка, вторых загрузок и частей файлов) сами не завершаются,
+                # пулы останавливаются ниже
+                if _thread.name.startswith(('ymd-engine', 'ymd-pool', 'ymd-hedge', 'ymd-segment')):
+                    continue
                 if not _thread.isDaemon():
                     _thread_id = _thread.ident
                     logger.debug(f'Ожидание заверешния потока [{_thread_id}]')
                     _thread.join()
                     logger.debug(f'Поток [{_thread_id}] был завершён.')
             logger.debug('Все потоки завершены. Завершение основного потока...')
+            history.close_history_databases()
+            engine.close_engine()
+            network.close_hedge_executor()
+            network.close_segment_executor()
+            pool.close_worker_pools()
             self._window_main.destroy()
 
         self._window_main.focus_set()
@@ -828,87 +840,30 @@ class YandexMusicDownloader:
 
     def _database_create_tables(self):
         """
-        Создаем необходмые таблицы в базе данных, если их ещё нет
+        Создаем необходмые таблицы в базе данных, если их ещё нет.
+        Треки из старых таблиц плейлистов переносятся в общую таблицу с индексами (см. history.HistoryDatabase).
 
         :return:
         """
-        with sqlite3.connect(self._history_database_path) as db:
+        try:
+            history.get_history_database(self._history_database_path).create_schema()
             logger.debug(f'База данных по пути [{self._history_database_path}] была открыта.')
-            for playlist in self._wrapper.playlists:
-                playlist_title = utils.strip_bad_symbols(playlist.title).replace(' ', '_')
-                cur = db.cursor()
-                request = f"CREATE TABLE IF NOT EXISTS table_{playlist_title}(" \
-                          f"track_id TEXT NOT NULL," \
-                          f"artist_id TEXT NOT NULL," \
-                          f"album_id TEXT," \
-                          f"track_name TEXT NOT NULL," \
-                          f"artist_name TEXT NOT NULL," \
-                          f"album_name TEXT," \
-                          f"genre TEXT," \
-                          f"track_number INTEGER NOT NULL," \
-                          f"disk_number INTEGER NOT NULL," \
-                          f"year INTEGER," \
-                          f"release_data TEXT," \
-                          f"bit_rate INTEGER NOT NULL," \
-                          f"codec TEXT NOT NULL," \
-                          f"is_favorite INTEGER NOT NULL," \
-                          f"is_explicit INTEGER NOT NULL DEFAULT 0," \
-                          f"is_popular INTEGER NOT NULL DEFAULT 0" \
-                          f")"
-                cur.execute(request)
+        except sqlite3.Error as e:
+            logger.error(f'Не удалось подготовить базу данных [{self._history_database_path}]: {e}')
 
     def _database_modify_tables(self):
         """
-        Метод для произведения различных изменений с существующей базой данных
+        Метод для произведения различных изменений с существующей базой данных: переносит старые таблицы
+        плейлистов в новую схему
 
         :return:
         """
 
         try:
-            with sqlite3.connect(self._history_database_path) as conn:
-                cursor = conn.cursor()
-                logger.debug(f'База данных по пути [{self._history_database_path}] была открыта.')
-            
-                # Получение списка всех таблиц в базе данных
-                cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
-                tables = cursor.fetchall()
-
-                for table in tables:
-                    table_name = table[0]
-
-                    logger.debug(f'Пытаюсь изменить таблицу {table_name}.')
-
-                    # Выполнение SQL-запроса для конвертации столбца в каждой таблице
-                    cursor.execute(f"PRAGMA foreign_keys=off;")
-                    cursor.execute(f"BEGIN TRANSACTION;")
-                    cursor.execute(f"ALTER TABLE {table_name} RENAME TO {table_name}_tmp;")
-                    cursor.execute(f"CREATE TABLE {table_name} ("\
-                                f"track_id TEXT NOT NULL," \
-                                f"artist_id TEXT NOT NULL," \
-                                f"album_id TEXT," \
-                                f"track_name TEXT NOT NULL," \
-                                f"artist_name TEXT NOT NULL," \
-                                f"album_name TEXT," \
-                                f"genre TEXT," \
-                                f"track_number INTEGER NOT NULL," \
-                                f"disk_number INTEGER NOT NULL," \
-                                f"year INTEGER," \
-                                f"release_data TEXT," \
-                                f"bit_rate INTEGER NOT NULL," \
-                                f"codec TEXT NOT NULL," \
-                                f"is_favorite INTEGER NOT NULL," \
-                                f"is_explicit INTEGER NOT NULL DEFAULT 0," \
-                                f"is_popular INTEGER NOT NULL DEFAULT 0);")
-                    cursor.execute(f'INSERT INTO {table_name} SELECT * FROM {table_name}_tmp;')
-                    cursor.execute(f"DROP TABLE {table_name}_tmp;")
-                    cursor.execute(f"COMMIT;")
-                    cursor.execute(f"PRAGMA foreign_keys=on;")
-
-                # Сохранение изменений
-                conn.commit()
-                logger.debug(f'Все изменения успешно сохранены.')
-
-                widgets.CustomMessageBox.show_info(self._window_main, 'Параметры Базы данных успешно обновлены!')
+            history.get_history_database(self._history_database_path).create_schema()
+            logger.debug(f'Все изменения успешно сохранены.')
+
+            widgets.CustomMessageBox.show_info(self._window_main, 'Параметры Базы данных успешно обновлены!')
     
         except Exception as e:
             logger.error(f"Произошла ошибка при попытке изменить данные БД.")
@@ -1706,6 +1661,8 @@ class YandexMusicDownloader:
             self._master = _master
 
             self._client = None
+            # Общий для клиента и всех воркеров пул keep-alive соединений
+            self._http_pool = network.get_http_pool()
             self._liked_tracks = []
             self._actioned_playlists = {}
 
@@ -1734,7 +1691,7 @@ class YandexMusicDownloader:
                 # Проверяем введённый токен на валидность
                 try:
                     Client.notice_displayed = True
-                    self._client = Client(token=self.token)
+                    self._client = Client(token=self.token, request=network.PooledRequest(self._http_pool))
                     self._client.init()
                     logger.debug('Введённый токен валиден, авторизация прошла успешно!')
                 except UnauthorizedError:
@@ -1925,18 +1882,35 @@ class YandexMusicDownloader:
                 """
 
             is_finishing_downloading = False
+            is_paused = False
+            prefetcher = None
+            watchdog = None
+            bandwidth_share = None
+            fair_job = None
 
             logger.debug(f'Начинаю распаршивать датафрейм.')
 
             def _pause_download():
+                nonlocal is_paused
+                is_paused = not is_paused
                 for _worker in workers:
-                    logger.debug(f'Устанавливая/Снимаю флаг паузы для потока [{_worker.ident}].')
-                    _worker.pause()
+                    if is_paused:
+                        logger.debug(f'Устанавливаю флаг паузы для потока [{_worker.ident}].')
+                        _worker.pause()
+                    else:
+                        logger.debug(f'Снимаю флаг паузы для потока [{_worker.ident}].')
+                        _worker.resume()
 
             def _break_download():
+                nonlocal is_finishing_downloading
+                is_finishing_downloading = True
+
                 for _worker in workers:
                     logger.debug(f'Устанавливая флаг завершения для потока [{_worker.ident}].')
                     _worker.close()
+                # Будим воркеров, ожидающих слот в общем планировщике
+                if fair_job is not None:
+                    fair_job.close()
 
                 # Ожидаем их завершения
                 for _worker in workers:
@@ -1944,19 +1918,15 @@ class YandexMusicDownloader:
                     _worker.join()
                     logger.debug(f'Поток (worker) [{_worker.ident}] был завершён.')
 
-                nonlocal is_finishing_downloading
-                is_finishing_downloading = True
-
-            def _network_error(*args):
-                for _worker in workers:
-                    logger.debug(f'Устанавливая флаг завершения для потока [{_worker.ident}].')
-                    _worker.close()
-                nonlocal is_finishing_downloading
-                is_finishing_downloading = True
+                # Дожидаемся фиксации изменений, которые воркеры отправили в базу истории
+                history.get_history_database(self._history_database_path).flush()
 
-                download_info['end'].set(True)
-                widgets.CustomMessageBox.show_error(self._master, 'Не удалось связаться с сервисом Яндекс Музыка!\n\n'
-                                               'Проверьте ваше подключение к Интернету или попробуйте позже.')
+                if prefetcher is not None:
+                    prefetcher.close()
+                if watchdog is not None:
+                    watchdog.close()
+                if bandwidth_share is not None:
+                    bandwidth_share.close()
 
             # Добавляем в окно загрузки
             widgets_variables, download_info, tab_number = self._create_download_instance(
@@ -1966,33 +1936,169 @@ class YandexMusicDownloader:
                 action_type=action_type
             )
 
-            mutex = threading.Lock()
-            network_is_ok = tk.BooleanVar(value=True)
-            network_is_ok.trace_add('write', _network_error)
+            # Общая очередь треков для всех воркеров текущей вкладки
+            tracks_queue = pool.TaskQueue()
+
+            # Создаем воркера, который раздаёт треки: в пул потоков, общий для всех вкладок, в event loop движка
+            # или в конвейер. Количество одновременно обрабатываемых треков ограничивает адаптивный контроллер
+            number_of_workers = 1
+            if config.DOWNLOAD_ENGINE == 'asyncio':
+                engine_name = 'asyncio'
+                helper_class = self.AsyncDownloaderHelper
+                concurrency = self._create_concurrency_controller(
+                    initial=config.ADAPTIVE_ASYNC_INITIAL_TASKS,
+                    maximum=config.ASYNC_NUMBER_OF_TASKS
+                )
+            elif config.DOWNLOAD_ENGINE == 'pipeline' and action_type == 'd':
+                engine_name = 'pipeline'
+                helper_class = self.PipelineDownloaderHelper
+                concurrency = self._create_concurrency_controller(
+                    initial=config.PIPELINE_STAGES_WORKERS['audio'],
+                    maximum=config.ADAPTIVE_MAX_WORKERS
+                )
+            else:
+                engine_name = 'threads'
+                helper_class = self.DownloaderHelper
+                concurrency = self._create_concurrency_controller(
+                    initial=self.number_of_workers,
+                    maximum=config.ADAPTIVE_MAX_WORKERS
+                )
+
+            # Общие для воркеров вкладки повторы запросов и предохранитель: при временных ошибках запрос повторяется,
+            # а если сервис недоступен, то воркеры ждут его восстановления, вместо того чтобы завершать вкладку
+            breaker = network.CircuitBreaker()
+            retry_policy = network.RetryPolicy(breaker=breaker, on_failure=concurrency.record_failure)
+
+            # Доля вкладки в общем ограничителе скорости. Ограничение и вес меняются в окне загрузки
+            bandwidth_limiter = network.get_bandwidth_limiter()
+            bandwidth_share = bandwidth_limiter.create_share(download_info['bandwidth_weight'].get())
+            download_info['bandwidth_limit'].set(bandwidth_limiter.rate // 1024)
+            applied_bandwidth_limit = bandwidth_limiter.rate
+
+            # Задание вкладки в общем планировщике движка: все вкладки движка вместе обрабатывают не больше
+            # config.GLOBAL_MAX_ACTIVE_TASKS[engine_name] треков, а слоты делятся между ними пропорционально приоритетам
+            global_limit = config.GLOBAL_MAX_ACTIVE_TASKS.get(engine_name, 0)
+            if engine_name in ('threads', 'pipeline') and global_limit <= 0:
+                # По ограничению выбирается размер общего пула потоков движка, поэтому оно обязательно
+                global_limit = config.ADAPTIVE_MAX_WORKERS
+            if 0 < global_limit < concurrency.maximum:
+                logger.warning(f'Общее ограничение {global_limit} движка [{engine_name}] меньше максимального '
+                               f'количества загрузок вкладки {concurrency.maximum}.')
+            fair_job = pool.get_fair_scheduler(engine_name, global_limit).create_job(download_info['priority'].get())
+
+            # Токен отмены вкладки: при остановке прерывает текущие загрузки (закрывая их соединения) и запись тегов
+            cancel_token = network.CancellationToken()
+
+            # Общее для всех вкладок хранилище аудио внутри папки загрузки, на файлы которого ссылаются плейлисты
+            content_store = None
+            if action_type == 'd' and config.CONTENT_STORE:
+                content_store = store.get_content_store(f'{self._download_folder_path}/{config.CONTENT_STORE_DIRNAME}')
 
-            # Создаем воркеров
             workers = []
-            logger.debug(f'Создаю {self.number_of_workers} воркера(-ов) для работы.')
-            for i in range(self.number_of_workers):
-                worker = self.DownloaderHelper(
-                    mutex=mutex,
-                    tracks_queue=None,
+            logger.debug(f'Создаю {number_of_workers} воркера(-ов) для работы.')
+            for i in range(number_of_workers):
+                worker = helper_class(
+                    tracks_queue=tracks_queue,
                     action_type=action_type,
                     special_modes=special_modes
                 )
                 worker.setDaemon(True)
                 worker.set_history_database(self._history_database_path)
                 worker.set_favorite_tracks(self._liked_tracks)
-                worker.set_network_event_var(network_is_ok)
+                worker.set_concurrency_controller(concurrency)
+                worker.set_retry_policy(retry_policy)
+                worker.set_bandwidth_share(bandwidth_share)
+                worker.set_fair_job(fair_job)
+                worker.set_cancel_token(cancel_token)
+                if content_store is not None:
+                    worker.set_content_store(content_store)
 
                 worker.start()
                 workers.append(worker)
                 self._download_workers_threads.append(worker)
 
-            playlist_counter = 0
-            were_downloaded_tracks_sum = 0
-            were_not_downloaded_tracks_sum = 0
+            # Пока воркеры качают, варианты загрузки и прямые ссылки для следующих треков запрашиваются заранее
+            if action_type == 'd' and config.PREFETCH_LOOKAHEAD > 0:
+                prefetcher = pool.Prefetcher(
+                    resolve=workers[0].prefetch_download_info,
+                    lookahead=config.PREFETCH_LOOKAHEAD,
+                    ttl=config.PREFETCH_TTL,
+                    number_of_workers=config.PREFETCH_WORKERS
+                )
+                for worker in workers:
+                    worker.set_prefetcher(prefetcher)
+
+            # Длительности загрузок текущей вкладки, по которым определяется, какую загрузку пора подстраховать
+            if action_type == 'd' and config.HEDGED_REQUESTS:
+                latency_tracker = network.LatencyTracker()
+                for worker in workers:
+                    worker.set_latency_tracker(latency_tracker)
+
+            # Сторож прерывает загрузки, которые перестали получать данные, и воркеры возвращают их треки в очередь
+            if action_type == 'd' and config.STALL_WATCHDOG:
+                watchdog = network.StallWatchdog()
+                watchdog.start()
+                for worker in workers:
+                    worker.set_stall_watchdog(watchdog)
+
+            playlists = []
+            http_stats_on_start = self._http_pool.get_stats()
+
+            def _update_download_info():
+                download_info['successful_download'].set(sum(_playlist.downloaded_tracks for _playlist in playlists))
+                download_info['failed_download'].set(sum(_playlist.not_downloaded_tracks for _playlist in playlists))
+                download_info['concurrency'].set(concurrency.limit)
+
+                # Статистика пула соединений общая для всех вкладок, поэтому показываем прирост с начала работы вкладки
+                http_stats = self._http_pool.get_stats()
+                download_info['http_requests'].set(http_stats['requests'] - http_stats_on_start['requests'])
+                download_info['http_reused'].set(max(0, http_stats['reused'] - http_stats_on_start['reused']))
+                if watchdog is not None:
+                    download_info['stalls'].set(watchdog.stalls)
+                if download_info['service_available'].get() != breaker.is_available():
+                    download_info['service_available'].set(breaker.is_available())
+                _update_limits()
+
+            def _update_limits():
+                # Применяем ограничение скорости, долю и приоритет вкладки, изменённые в окне загрузки
+                nonlocal applied_bandwidth_limit
+                try:
+                    limit = max(0, download_info['bandwidth_limit'].get()) * 1024
+                    weight = download_info['bandwidth_weight'].get()
+                    priority = download_info['priority'].get()
+                except tk.TclError:
+                    # В поле ввода сейчас не число
+                    return
 
+                bandwidth_share.set_weight(weight)
+                fair_job.set_weight(priority)
+                # Ограничение общее для всех вкладок: применяем его, если его изменили в этой вкладке,
+                # иначе показываем значение, установленное в другой вкладке
+                if limit != applied_bandwidth_limit:
+                    bandwidth_limiter.set_rate(limit)
+                    logger.debug(f'Общее ограничение скорости изменено на [{limit // 1024}] КБ/с.')
+                elif bandwidth_limiter.rate != limit:
+                    download_info['bandwidth_limit'].set(bandwidth_limiter.rate // 1024)
+                applied_bandwidth_limit = bandwidth_limiter.rate
+
+            def _enqueue_track(_playlist, _track):
+                if prefetcher is not None:
+                    prefetcher.add(self.DownloaderHelper.get_prefetch_key(_playlist, _track), _playlist, _track)
+                tracks_queue.put((_playlist, _track))
+
+            # При скачивании треки сначала собираются со всех плейлистов, чтобы упорядочить их по размеру
+            is_largest_first = action_type == 'd' and config.LARGEST_FIRST_SCHEDULING
+            scheduled_tracks = []
+
+            # Отметки любимых треков обновляются и отсутствующие треки добавляются в базу для каждого плейлиста
+            # целиком одной транзакцией, а не по треку в воркерах
+            liked_ids = None
+            if action_type == 'uf' and config.BULK_DATABASE_ACTIONS:
+                liked_ids = self._get_liked_ids(retry_policy)
+            is_bulk_ingest = action_type == 'adb' and config.BULK_DATABASE_ACTIONS
+
+            # Отправляем треки всех плейлистов в общую очередь, не дожидаясь обработки предыдущих плейлистов
+            playlist_counter = 0
             while not playlists_queue.empty():
                 if self.main_window_state is False:
                     logger.debug(f'Главное окно получило команду на завершение. Выхожу.')
@@ -2007,10 +2113,6 @@ class YandexMusicDownloader:
                 widgets_variables[playlist_counter]['progressbar_size'].set(len(playlist_data))
                 widgets_variables[playlist_counter]['playlist_name'].set(playlist_title)
 
-                time.sleep(0.1)
-
-                tracks_queue = Queue()
-
                 logger.debug(f'Начинаю работу с плейлистом [{playlist_title}]. '
                              f'Действие: [{config.Actions.actions_dict_text[action_type]}].')
 
@@ -2039,55 +2141,62 @@ class YandexMusicDownloader:
                 with open(f'{download_folder_path}/info/downloaded.txt', 'w', encoding='utf-8'):
                     pass
 
-                # Меняем значения у воркеров
-                for worker in workers:
-                    worker.set_tracks_queue(tracks_queue)
-                    worker.set_playlist_title(playlist_title)
-                    worker.set_download_folder(download_folder_path)
-                    worker.set_download_progress_var(widgets_variables[playlist_counter]['progressbar_val'])
+                playlist = self.PlaylistJob(title=playlist_title,
+                                            download_folder_path=download_folder_path,
+                                            widget_variables=widgets_variables[playlist_counter],
+                                            number_of_tracks=len(playlist_data))
+                playlists.append(playlist)
+                if not playlist_data:
+                    playlist.finish()
 
-                # Начинаем заполнять очередь треков
-                for playlist_track in playlist_data:
-                    tracks_queue.put(playlist_track)
+                # Треки плейлиста, уже записанные в базу, загружаем один раз: дальше воркеры проверяют их в памяти
+                try:
+                    history.get_history_database(self._history_database_path).get_known_tracks(playlist.table_title)
+                except sqlite3.Error as e:
+                    logger.error(f'Не удалось загрузить треки плейлиста [{playlist_title}] из базы данных: {e}')
 
-                while not tracks_queue.empty():
-                    if self.main_window_state is False:
-                        logger.debug(f'Главное окно получило команду на завершение. Выхожу.')
-                        return
-                    elif is_finishing_downloading is True:
-                        logger.debug(f'Поток текущей загрузки получил команду на завершение. Выхожу.')
-                        return
+                if liked_ids is not None and playlist_data:
+                    self._update_liked_tracks_in_database(playlist, playlist_data, liked_ids)
+                    playlist_counter += 1
+                    continue
+                if is_bulk_ingest and playlist_data:
+                    try:
+                        workers[0].add_tracks_to_database(playlist, playlist_data)
+                    except sqlite3.Error as e:
+                        logger.error(f'Не удалось загрузить треки плейлиста [{playlist_title}] из базы данных: {e}')
+                        playlist.complete(0, len(playlist_data))
+                    playlist_counter += 1
+                    continue
 
-                    were_downloaded_tracks = 0
-                    were_not_downloaded_tracks = 0
-                    for worker in workers:
-                        were_downloaded_tracks += worker.downloaded_tracks
-                        were_not_downloaded_tracks += worker.not_downloaded_tracks
-                    download_info['successful_download'].set(were_downloaded_tracks + were_downloaded_tracks_sum)
-                    download_info['failed_download'].set(were_not_downloaded_tracks + were_not_downloaded_tracks_sum)
-                    time.sleep(0.1)
-
-                # Закончили работать с текущим плейлистом
-                were_downloaded_tracks = 0
-                were_not_downloaded_tracks = 0
-                for worker in workers:
-                    while worker.get_state() is True:
-                        time.sleep(0.1)
+                for playlist_track in playlist_data:
+                    if is_largest_first:
+                        scheduled_tracks.append((playlist, playlist_track))
+                    else:
+                        _enqueue_track(playlist, playlist_track)
 
-                    were_downloaded_tracks += worker.downloaded_tracks
-                    were_not_downloaded_tracks += worker.not_downloaded_tracks
-                    worker.downloaded_tracks = 0
-                    worker.not_downloaded_tracks = 0
+                playlist_counter += 1
 
-                were_downloaded_tracks_sum += were_downloaded_tracks
-                were_not_downloaded_tracks_sum += were_not_downloaded_tracks
-                widgets_variables[playlist_counter]['successful_download'].set(were_downloaded_tracks)
-                widgets_variables[playlist_counter]['failed_download'].set(were_not_downloaded_tracks)
-                download_info['successful_download'].set(were_downloaded_tracks_sum)
-                download_info['failed_download'].set(were_not_downloaded_tracks_sum)
+            # Треки всех плейлистов вкладки отправляем в очередь от больших к маленьким
+            for playlist, playlist_track in pool.order_largest_first(
+                    scheduled_tracks,
+                    get_size=lambda _item: self.DownloaderHelper.estimate_transfer_size(_item[1]),
+                    small_every=config.LARGEST_FIRST_SMALL_EVERY):
+                _enqueue_track(playlist, playlist_track)
 
-                playlist_counter += 1
-                time.sleep(0.1)
+            # Ждём, пока воркеры обработают все треки, периодически обновляя счётчики
+            while not tracks_queue.wait_done(timeout=0.5):
+                if self.main_window_state is False:
+                    logger.debug(f'Главное окно получило команду на завершение. Выхожу.')
+                    return
+                elif is_finishing_downloading is True:
+                    logger.debug(f'Поток текущей загрузки получил команду на завершение. Выхожу.')
+                    return
+                _update_download_info()
+
+            if is_finishing_downloading is True:
+                logger.debug(f'Поток текущей загрузки получил команду на завершение. Выхожу.')
+                return
+            _update_download_info()
 
             download_info['end'].set(True)
             widgets.CustomMessageBox.show_success(self._master, f'Действие для вкладки #{tab_number} завершено!')
@@ -2095,149 +2204,434 @@ class YandexMusicDownloader:
                          f' Работа завершена - выхожу.')
             _break_download()
 
+        def _get_liked_ids(self, retry_policy) -> set:
+            """
+            Множество id лайкнутых треков. Лайки запрашиваются заново, так как могли измениться после запуска.
+
+            :param retry_policy: повторы запросов вкладки
+            :return:
+            """
+            try:
+                self._liked_tracks = retry_policy.call(self._client.users_likes_tracks)
+            except (NetworkError, YandexMusicError) as e:
+                logger.error(f'Не удалось обновить список любимых треков, использую полученный при запуске: {e}')
+            return {str(track.id) for track in self._liked_tracks}
+
+        def _update_liked_tracks_in_database(self, playlist, playlist_data, liked_ids):
+            """
+            Обновляет отметки любимых треков плейлиста в базе данных одной транзакцией.
+            Треки, которых нет в базе, считаются необработанными.
+
+            :param playlist: плейлист
+            :param playlist_data: треки плейлиста
+            :param liked_ids: множество id лайкнутых треков
+            :return:
+            """
+            history_database = history.get_history_database(self._history_database_path)
+            try:
+                known_tracks = history_database.get_known_tracks(playlist.table_title)
+                tracks_in_database = [track_data for track_data in playlist_data
+                                      if known_tracks.contains(track_data['id'], track_data['title'],
+                                                               track_data['artists'])]
+                history_database.update_favorites(playlist.table_title,
+                                                  [track_data['id'] for track_data in tracks_in_database],
+                                                  liked_ids).result()
+            except sqlite3.Error as e:
+                logger.error(f'Не удалось обновить любимые треки плейлиста [{playlist.title}] в базе данных: {e}')
+                playlist.complete(0, len(playlist_data))
+                return
+
+            logger.debug(f'Отметки любимых треков плейлиста [{playlist.title}] обновлены, '
+                         f'треков нет в базе данных: {len(playlist_data) - len(tracks_in_database)}.')
+            playlist.complete(len(tracks_in_database), len(playlist_data) - len(tracks_in_database))
+
+        @staticmethod
+        def _create_concurrency_controller(initial, maximum):
+            """
+            Создаёт контроллер количества одновременных загрузок для вкладки
+
+            :param initial: начальное количество одновременных загрузок
+            :param maximum: максимальное количество одновременных загрузок
+            :return:
+            """
+            if not config.ADAPTIVE_CONCURRENCY:
+                return pool.AimdController(initial=initial)
+
+            return pool.AimdController(
+                initial=initial,
+                minimum=config.ADAPTIVE_MIN_WORKERS,
+                maximum=maximum,
+                window=config.ADAPTIVE_WINDOW,
+                error_rate_threshold=config.ADAPTIVE_ERROR_RATE,
+                latency_factor=config.ADAPTIVE_LATENCY_FACTOR,
+                decrease_factor=config.ADAPTIVE_DECREASE_FACTOR,
+                baseline_decay=config.ADAPTIVE_BASELINE_DECAY
+            )
+
+        class PlaylistJob:
+            """
+            Плейлист в рамках одной вкладки: папка загрузки, таблица в базе данных, виджеты и счётчики.
+            Передаётся воркерам вместе с каждым треком, поэтому треки разных плейлистов обрабатываются вперемешку.
+            """
+
+            def __init__(self, title, download_folder_path, widget_variables, number_of_tracks):
+                self.title = title
+                self.table_title = utils.strip_bad_symbols(title).replace(' ', '_')
+                self.download_folder_path = download_folder_path
+                self.widget_variables = widget_variables
+                # Политика выбора кодека и битрейта для треков плейлиста
+                self.quality_policy = quality.QualityPolicy.for_playlist(title)
+
+                self.downloaded_tracks = 0
+                self.not_downloaded_tracks = 0
+                self._remaining_tracks = number_of_tracks
+                # id трека -> сколько раз его загрузка зависала
+                self._stalls = {}
+                # id трека -> кодек уже скачанного файла, который нужно заменить вариантом получше
+                self._upgrades = {}
+                self._lock = threading.Lock()
+
+            def count_success(self):
+                """
+                Увеличивает счётчик успешно обработанных треков
+
+                :return:
+                """
+                with self._lock:
+                    self.downloaded_tracks += 1
+
+            def count_failure(self):
+                """
+                Увеличивает счётчик необработанных треков
+
+                :return:
+                """
+                with self._lock:
+                    self.not_downloaded_tracks += 1
+
+            def count_stall(self, track_id):
+                """
+                Увеличивает счётчик зависаний загрузки трека
+
+                :param track_id: id трека
+                :return: сколько раз загрузка трека зависала
+                """
+                with self._lock:
+                    self._stalls[track_id] = self._stalls.get(track_id, 0) + 1
+                    return self._stalls[track_id]
+
+            def mark_upgrade(self, track_id, codec):
+                """
+                Отмечает, что уже скачанный трек нужно перекачать в варианте, предпочтительном по политике качества
+
+                :param track_id: id трека
+                :param codec: кодек уже скачанного файла
+                :return:
+                """
+                with self._lock:
+                    self._upgrades[track_id] = codec
+
+            def is_upgrade(self, track_id) -> bool:
+                with self._lock:
+                    return track_id in self._upgrades
+
+            def pop_upgrade(self, track_id):
+                """
+                Снимает отметку о замене трека
+
+                :param track_id: id трека
+                :return: кодек заменяемого файла, либо None, если трек не заменяется
+                """
+                with self._lock:
+                    return self._upgrades.pop(track_id, None)
+
+            def track_done(self):
+                """
+                Увеличивает значение прогрессбара плейлиста. После последнего трека выводит итоги в виджет.
+
+                :return:
+                """
+                with self._lock:
+                    self._remaining_tracks -= 1
+                    is_finished = self._remaining_tracks == 0
+                    progress = self.widget_variables['progressbar_val']
+                    progress.set(progress.get() + 1)
+
+                if is_finished:
+                    self.finish()
+
+            def complete(self, successes: int, failures: int):
+                """
+                Отмечает обработанными все оставшиеся треки плейлиста разом (для действий, выполняемых
+                для всего плейлиста сразу) и выводит итоги в виджет
+
+                :param successes: количество успешно обработанных треков
+                :param failures: количество необработанных треков
+                :return:
+                """
+                with self._lock:
+                    self.downloaded_tracks += successes
+                    self.not_downloaded_tracks += failures
+                    progress = self.widget_variables['progressbar_val']
+                    progress.set(progress.get() + self._remaining_tracks)
+                    self._remaining_tracks = 0
+                self.finish()
+
+            def finish(self):
+                """
+                Выводит итоговые результаты плейлиста в его виджет
+
+                :return:
+                """
+                logger.debug(f'Работа с плейлистом [{self.title}] завершена.')
+                self.widget_variables['successful_download'].set(self.downloaded_tracks)
+                self.widget_variables['failed_download'].set(self.not_downloaded_tracks)
+
+            def write_error(self, message):
+                """
+                Добавляет сообщение в файл ошибок плейлиста
+
+                :param message: текст ошибки
+                :return:
+                """
+                with self._lock:
+                    with open(f"{self.download_folder_path}/info/errors.txt", 'a', encoding='utf-8') as file:
+                        file.write(f"{message}\n")
+
+            def write_downloaded(self, track_name):
+                """
+                Добавляет трек в файл скачанных треков плейлиста
+
+                :param track_name: имя трека
+                :return:
+                """
+                with self._lock:
+                    with open(f"{self.download_folder_path}/info/downloaded.txt", 'a', encoding='utf-8') as file:
+                        file.write(f'{track_name}\n')
+
         class DownloaderHelper(threading.Thread):
-            def __init__(self, mutex, tracks_queue, action_type, special_modes):
+            def __init__(self, tracks_queue, action_type, special_modes):
                 threading.Thread.__init__(self)
 
-                self.mutex = mutex
-
                 self.tracks_queue = tracks_queue
                 self.action_type = action_type
                 self.special_modes = special_modes
 
-                self.playlist_title = None
-                self.download_folder_path = None
                 self.history_database_path = None
+                self._history = None
 
                 self.favorite_tracks = None
 
-                self.download_progress = None
-                self.downloaded_tracks = 0
-                self.not_downloaded_tracks = 0
-
                 self._close_worker = False
-                self._pause_worker = False
                 self._state_working = False
 
-                self._network_is_ok = None
+                # Событие установлено - воркер работает, сброшено - стоит на паузе
+                self._resume_event = threading.Event()
+                self._resume_event.set()
+
+                self._concurrency = None
+                self._retry_policy = None
+                self._prefetcher = None
+                self._latency_tracker = None
+                self._watchdog = None
+                self._bandwidth_share = None
+                self._content_store = None
+                self._fair_job = None
+                self._cancel_token = None
+
+                # Треки, отправленные на обработку в общий пул
+                self._futures = set()
+                self._futures_lock = threading.Lock()
 
             def run(self):
                 """
-                Основной метод работы воркера
+                Основной метод работы воркера: забирает треки из очереди вкладки и отдаёт их на обработку в общий
+                для всех вкладок пул потоков. Слоты контроллера вкладки и общего планировщика занимаются до отправки
+                трека, а планировщик выдаёт не больше слотов, чем потоков в пуле, поэтому трек не ждёт потока.
 
                 :return:
                 """
+                worker_pool = pool.get_worker_pool('threads', self._fair_job.limit)
                 while not self._close_worker:
-                    if self._pause_worker is False:
-                        if self.tracks_queue is not None:
-                            self.mutex.acquire()
-                            if not self.tracks_queue.empty():
-                                try:
-                                    self._state_working = True
-                                    logger.debug(f'Получаю данные из очереди.')
-                                    data = self.tracks_queue.get()
-                                    logger.debug(f'Получил данные из очереди.')
-                                    self.mutex.release()
-
-                                    if self._do_work(data):
-                                        self._increase_progress()
-                                except (NetworkError, YandexMusicError):
-                                    logger.error('Не удалось связаться с сервисом Яндекс Музыка!')
-                                    self.not_downloaded_tracks += 1
-                                    self._increase_progress()
-
-                                    self.mutex.acquire()
-                                    if self._network_is_ok.get() is True:
-                                        self._network_is_ok.set(False)
-                                    self.mutex.release()
-                                    break
-                            else:
-                                self._state_working = False
-                                logger.debug(f'Очередь пуста.')
-                                self.mutex.release()
-                    time.sleep(0.01)
-
-            def _increase_progress(self):
-                """
-                Увеличиваем значение прогрессбара для текущего плейлиста
+                    # Блокируемся на очереди, пока не появится трек или маркер завершения
+                    data = self.tracks_queue.get()
+                    if data is pool.TaskQueue.STOP:
+                        logger.debug(f'Получен маркер завершения.')
+                        self.tracks_queue.task_done()
+                        break
 
-                :return:
-                """
+                    # Если стоим на паузе, то ждём её снятия
+                    self._resume_event.wait()
+
+                    # Слот контроллера берём только с треком на руках, а затем ждём своей очереди в общем
+                    # для всех вкладок ограничении одновременных задач
+                    if self._close_worker or not self._concurrency.acquire():
+                        self.tracks_queue.task_done()
+                        break
+                    if self._close_worker or not self._fair_job.acquire():
+                        self._concurrency.release()
+                        self.tracks_queue.task_done()
+                        break
+
+                    self._state_working = True
+                    with self._futures_lock:
+                        future = worker_pool.submit(self._process_track, data)
+                        self._futures.add(future)
+                    future.add_done_callback(self._track_processed)
 
-                self.mutex.acquire()
-                self.download_progress.set(self.download_progress.get() + 1)
-                self.mutex.release()
+                # Дожидаемся треков, которые ещё обрабатываются
+                with self._futures_lock:
+                    futures = list(self._futures)
+                concurrent.futures.wait(futures)
+                self._state_working = False
+
+            def _process_track(self, data):
+                """
+                Обрабатывает трек в потоке общего пула и освобождает занятые для него слоты
 
-            def _do_work(self, track_data):
+                :param data: (плейлист, трек)
+                :return:
+                """
+                playlist, track_data = data
+                is_success = True
+                try:
+                    logger.debug(f'Получил данные из очереди.')
+                    if self._do_work(playlist, track_data):
+                        playlist.track_done()
+                except network.TransferStalledError:
+                    is_success = False
+                    self._requeue_stalled_track(playlist, track_data)
+                except network.DownloadCancelledError as e:
+                    logger.debug(f'Обработка трека прервана: {e}')
+                except (NetworkError, YandexMusicError) as e:
+                    is_success = False
+                    self._report_network_failure(playlist, track_data, e)
+                except Exception as e:
+                    logger.error(f'Ошибка при обработке трека: {e}')
+                    playlist.count_failure()
+                    playlist.track_done()
+                finally:
+                    self._fair_job.release()
+                    # Длительность успешных загрузок учитывается в _record_transfer()
+                    if not is_success:
+                        self._concurrency.record_failure()
+                    self._concurrency.release()
+                    self.tracks_queue.task_done()
+
+            def _track_processed(self, future):
+                with self._futures_lock:
+                    self._futures.discard(future)
+                    if not self._futures:
+                        self._state_working = False
+
+            def _do_work(self, playlist, track_data):
                 """
                 В зависимости от экшена выполняем то или иное действие
 
+                :param playlist: плейлист трека
                 :param track_data: текущий трек
                 :return:
                 """
 
                 if self.action_type == 'd':
-                    return self._download_track(track_data)
+                    return self._download_track(playlist, track_data)
                 elif self.action_type == 'u':
-                    return self._update_track_metadata(track_data)
+                    return self._update_track_metadata(playlist, track_data)
                 elif self.action_type == 'adb':
-                    return self._add_track_to_database(track_data)
+                    return self._add_track_to_database(playlist, track_data)
                 elif self.action_type == 'uf':
-                    return self._update_liked_track_in_database(track_data)
+                    return self._update_liked_track_in_database(playlist, track_data)
 
-            def set_network_event_var(self, event):
+            def set_retry_policy(self, retry_policy):
                 """
-                Устанавливаем отслеживаемую переменную для получения ивента при ошибке соединения
+                Устанавливаем политику повторов сетевых запросов (вместе с предохранителем сервиса)
 
-                :param event: отслеживаемая переменная для получения ивента
+                :param retry_policy: политика повторов (network.RetryPolicy)
                 :return:
                 """
-                self._network_is_ok = event
+                self._retry_policy = retry_policy
 
-            def set_history_database(self, history_database_path):
+            def set_fair_job(self, fair_job):
                 """
-                Устанавливаем значение пути к базе данных для текущего воркера
+                Устанавливаем задание вкладки в общем для всех вкладок планировщике одновременных задач
 
-                :param history_database_path: путь к базе данных
+                :param fair_job: pool.FairScheduler.Job
                 :return:
                 """
-                self.history_database_path = history_database_path
+                self._fair_job = fair_job
 
-            def set_playlist_title(self, playlist_title):
+            def set_concurrency_controller(self, concurrency):
                 """
-                Устанавливаем значение названия плейлиста для текущего воркера
+                Устанавливаем контроллер, ограничивающий количество одновременно обрабатываемых треков
 
-                :param playlist_title: название плейлиста
+                :param concurrency: контроллер количества одновременных загрузок (pool.AimdController)
                 :return:
                 """
-                self.playlist_title = utils.strip_bad_symbols(playlist_title).replace(' ', '_')
+                self._concurrency = concurrency
 
-            def set_download_folder(self, download_folder_path):
+            def set_prefetcher(self, prefetcher):
                 """
-                Устанавливаем значение пути к папке загрузки для текущего воркера
+                Устанавливаем общий для вкладки объект, заранее получающий варианты загрузки следующих треков
 
-                :param download_folder_path: путь к папке загрузки
+                :param prefetcher: pool.Prefetcher
                 :return:
                 """
-                self.download_folder_path = download_folder_path
+                self._prefetcher = prefetcher
 
-            def set_tracks_queue(self, tracks_queue):
+            def set_latency_tracker(self, latency_tracker):
                 """
-                Устанавливаем значение очереди треков для текущего воркера
+                Устанавливаем общую для вкладки выборку длительностей загрузок для подстраховки медленных загрузок
 
-                :param tracks_queue: очередь треков для получения нового трека
+                :param latency_tracker: network.LatencyTracker
                 :return:
                 """
-                self.tracks_queue = tracks_queue
+                self._latency_tracker = latency_tracker
+
+            def set_stall_watchdog(self, watchdog):
+                """
+                Устанавливаем общего для вкладки сторожа зависших загрузок
+
+                :param watchdog: network.StallWatchdog
+                :return:
+                """
+                self._watchdog = watchdog
+
+            def set_bandwidth_share(self, bandwidth_share):
+                """
+                Устанавливаем долю вкладки в общем ограничителе скорости загрузки аудио и обложек
+
+                :param bandwidth_share: network.BandwidthLimiter.Share
+                :return:
+                """
+                self._bandwidth_share = bandwidth_share
 
-            def set_download_progress_var(self, download_progress_var):
+            def set_content_store(self, content_store):
                 """
-                Связываем прогрессбар текущего плейлиста с данным воркером
+                Устанавливаем общее хранилище аудио, на файлы которого ссылаются папки плейлистов
 
-                :param download_progress_var: отслеживаемая переменная текущего прогрессбара
+                :param content_store: store.ContentStore
                 :return:
                 """
-                self.download_progress = download_progress_var
+                self._content_store = content_store
+
+            def set_cancel_token(self, cancel_token):
+                """
+                Устанавливаем общий для вкладки токен отмены, прерывающий загрузки и запись тегов при остановке
+
+                :param cancel_token: network.CancellationToken
+                :return:
+                """
+                self._cancel_token = cancel_token
+
+            def set_history_database(self, history_database_path):
+                """
+                Устанавливаем значение пути к базе данных для текущего воркера
+
+                :param history_database_path: путь к базе данных
+                :return:
+                """
+                self.history_database_path = history_database_path
+                self._history = history.get_history_database(history_database_path)
 
             def set_favorite_tracks(self, favorite_tracks):
                 """
@@ -2255,6 +2649,12 @@ class YandexMusicDownloader:
                 :return:
                 """
                 self._close_worker = True
+                # Будим воркер, если он стоит на паузе или ждёт данные из очереди
+                self._resume_event.set()
+                self._concurrency.close()
+                self._retry_policy.cancel()
+                self._cancel_token.cancel()
+                self.tracks_queue.stop()
 
             def pause(self):
                 """
@@ -2262,7 +2662,15 @@ class YandexMusicDownloader:
 
                 :return:
                 """
-                self._pause_worker = not self._pause_worker
+                self._resume_event.clear()
+
+            def resume(self):
+                """
+                Сигнал на возобновление работы для воркера
+
+                :return:
+                """
+                self._resume_event.set()
 
             def get_state(self):
                 """
@@ -2272,10 +2680,11 @@ class YandexMusicDownloader:
                 """
                 return self._state_working
 
-            def _download_track(self, track_data):
+            def _download_track(self, playlist, track_data):
                 """
                 Скачивает полученный трек, параллельно добавляя о нём всю доступную информацию в базу данных.
 
+                :param playlist: плейлист трека
                 :param track_data: текущий трек
                 :return: True - если все нормально скачалось
                 """
@@ -2284,52 +2693,21 @@ class YandexMusicDownloader:
 
                 track_name = self._get_track_name(track_data)
 
-                # Если загружать только новые
-                if self.special_modes[config.Actions.check_actions['hist']]:
-                    if self._is_track_in_database(track_data):
-                        logger.debug(f'Трек [{track_name}] уже существует в базе '
-                                     f'[{self.history_database_path}]. Так как включён мод ONLY_NEW, выхожу.')
-                        return True
-                    else:
-                        logger.debug(f'Трека [{track_name}] нет в базе '
-                                     f'[{self.history_database_path}]. Подготавливаюсь к его загрузки.')
-
                 try:
-                    if not track_data['track'].available:
-                        logger.error(f'Трек [{track_name}] недоступен.')
-                        self.mutex.acquire()
-                        with open(f"{self.download_folder_path}/info/errors.txt", 'a', encoding='utf-8') as file:
-                            file.write(f"{track_name} ~ Трек недоступен\n")
-                        self.mutex.release()
-                        self.not_downloaded_tracks += 1
+                    download_info = self._prepare_track_download(playlist, track_data, track_name)
+                    if download_info is None:
                         return True
 
                     was_track_downloaded = False
                     track_exists = False
-                    for info in sorted(track_data['track'].get_download_info(), key=lambda x: x['bitrate_in_kbps'], reverse=True):
+                    for info in download_info:
                         codec = info.codec
                         bitrate = info.bitrate_in_kbps
-                        full_track_name = os.path.abspath(f'{self.download_folder_path}/{track_name}.{codec}')
+                        full_track_name = os.path.abspath(f'{playlist.download_folder_path}/{track_name}.{codec}')
 
                         # Если трек существует и мы не перезаписываем, то выходим, но скачала проеверяем, есть ли он в базе
-                        if os.path.exists(f'{full_track_name}') and not self.special_modes[config.Actions.check_actions['rw']]:
-                            logger.debug(f'Трек [{track_name}] уже существует на диске '
-                                         f'[{self.download_folder_path}]. Проверяю в базе.')
-
-                            if self._is_track_in_database(track_data):
-                                logger.debug(f'Трек [{track_name}] уже существует в базе '
-                                             f'[{self.history_database_path}]. Так как отключена перезапись, выхожу.')
-                            else:
-                                logger.debug(f'Трек [{track_name}] отсутствует в базе '
-                                             f'[{self.history_database_path}]. Так как отключена перезапись, просто '
-                                             f'добавляю его в базу и выхожу.')
-                                self.__add_track_to_database(track_data=track_data,
-                                                             codec=codec,
-                                                             bit_rate=bitrate,
-                                                             is_favorite=self._is_favorite_track(track_data['id'])
-                                                             )
-                                logger.debug(
-                                    f'Трек [{track_name}] был добавлен в базу данных [{self.history_database_path}].')
+                        if os.path.exists(f'{full_track_name}') and not self._is_rewritable(playlist, track_data):
+                            self._register_existing_track(playlist, track_data, track_name, codec, bitrate)
                             track_exists = True
                             break
 
@@ -2338,59 +2716,14 @@ class YandexMusicDownloader:
                                 return False
 
                             logger.debug(f'Начинаю загрузку трека [{track_name}].')
-                            track_data['track'].download(filename=full_track_name, codec=codec, bitrate_in_kbps=bitrate)
+                            self._request(self._download_audio, info, full_track_name, track_data['id'])
                             logger.debug(f'Трек [{track_name}] был скачан.')
 
-                            self.mutex.acquire()
-                            with open(f"{self.download_folder_path}/info/downloaded.txt", 'a', encoding='utf-8') as file:
-                                file.write(f'{track_name}\n')
-                            self.mutex.release()
-
-                            cover_filename = os.path.abspath(f'{self.download_folder_path}/covers/{track_name}.png')
-                            if not os.path.exists(cover_filename):
-                                logger.debug(f'Обложка для трека [{track_name}] не найдена, начинаю загрузку.')
-                                try:
-                                    track_data['track'].download_cover(cover_filename, size="300x300")
-                                    logger.debug(f'Обложка для трека [{track_name}] была скачана в [{cover_filename}].')
-                                except AttributeError:
-                                    logger.debug(f"Обложки для трека [{track_name}] не существует, создаю стандартную.")
-                                    self._create_cover(cover_filename)
-                                    logger.debug(f'Стандартная обложка для трека [{track_name}] была создана в [{cover_filename}].')
+                            cover_filename = os.path.abspath(f'{playlist.download_folder_path}/covers/{track_name}.png')
+                            self._fetch_track_cover(track_data, track_name, cover_filename)
 
-                            try:
-                                track_metadata = self._get_track_metadata(track_data)
-                                self._write_track_metadata(full_track_name=full_track_name,
-                                                           track_title=track_metadata['title'],
-                                                           artists=track_metadata['artists'],
-                                                           albums=track_metadata['albums'],
-                                                           genre=track_metadata['genre'],
-                                                           album_artists=track_metadata['album_artists'],
-                                                           year=track_metadata['year'],
-                                                           cover_filename=cover_filename,
-                                                           track_position=track_metadata['track_number'],
-                                                           disk_number=track_metadata['disk_number'],
-                                                           lyrics=track_metadata['lyrics'])
-                                logger.debug(f'Метаданные трека [{track_name}] были обновлены.')
-                            except AttributeError:
-                                logger.error(f'Не удалось обновить метаданные для файла [{full_track_name}].')
-                            except TypeError:
-                                logger.error(f'Не удалось обновить метаданные для файла [{full_track_name}].')
-
-                            if not self._is_track_in_database(track_data):
-                                logger.debug(f'Трек [{track_name}] отсутствует в базе данных по пути '
-                                             f'[{self.history_database_path}]. Добавляю в базу.')
-                                self.__add_track_to_database(track_data=track_data,
-                                                             codec=codec,
-                                                             bit_rate=bitrate,
-                                                             is_favorite=self._is_favorite_track(track_data['id'])
-                                                             )
-                                logger.debug(
-                                    f'Трек [{track_name}] был добавлен в базу данных [{self.history_database_path}].')
-                            else:
-                                logger.debug(f'Трек [{track_name}] уже присутствует в базе данных по пути '
-                                             f'[{self.history_database_path}].')
-
-                            self.downloaded_tracks += 1
+                            self._finish_track_download(playlist, track_data, track_name, full_track_name, cover_filename,
+                                                        codec, bitrate)
                             was_track_downloaded = True
                             break
                         except (YandexMusicError, TimeoutError):
@@ -2398,84 +2731,543 @@ class YandexMusicDownloader:
                                 f'Не удалось скачать трек [{track_name}] с кодеком [{codec}] и битрейтом [{bitrate}].')
                             continue
 
-                    if was_track_downloaded is False:
-                        if track_exists is False:
-                            logger.error(f'Не удалось скачать трек [{track_name}].')
-                            self.mutex.acquire()
-                            with open(f"{self.download_folder_path}/info/errors.txt", 'a', encoding='utf-8') as file:
-                                file.write(f"{track_name} ~ Не удалось скачать трек\n")
-                            self.mutex.release()
-                            self.not_downloaded_tracks += 1
+                    if was_track_downloaded is False and track_exists is False:
+                        self._report_failed_download(playlist, track_name)
 
                 except IOError:
                     logger.error(f'Ошибка при попытке записи в файла.')
-                    self.not_downloaded_tracks += 1
+                    playlist.count_failure()
                 return True
 
-            def _update_track_metadata(self, track_data):
+            def _prepare_track_download(self, playlist, track_data, track_name):
                 """
-                Обновляет метаданные трека
+                Проверяет, нужно ли скачивать трек, и получает доступные варианты загрузки
 
+                :param playlist: плейлист трека
                 :param track_data: текущий трек
-                :return:
+                :param track_name: имя трека
+                :return: список вариантов загрузки от лучшего к худшему, либо None, если скачивать не нужно
                 """
-                track_name = self._get_track_name(track_data)
+                # Если загружать только новые
+                if self.special_modes[config.Actions.check_actions['hist']]:
+                    if self._is_track_in_database(playlist, track_data):
+                        if config.QUALITY_UPGRADE_ON_SYNC and track_data['track'].available:
+                            download_info = self._get_quality_upgrade(playlist, track_data, track_name)
+                            if download_info is not None:
+                                return download_info
 
-                if self._close_worker is True:
-                    return False
+                        logger.debug(f'Трек [{track_name}] уже существует в базе '
+                                     f'[{self.history_database_path}]. Так как включён мод ONLY_NEW, выхожу.')
+                        self._discard_prefetched(playlist, track_data)
+                        return None
+                    else:
+                        logger.debug(f'Трека [{track_name}] нет в базе '
+                                     f'[{self.history_database_path}]. Подготавливаюсь к его загрузки.')
 
                 if not track_data['track'].available:
                     logger.error(f'Трек [{track_name}] недоступен.')
-                    self.mutex.acquire()
-                    with open(f"{self.download_folder_path}/info/errors.txt", 'a', encoding='utf-8') as file:
-                        file.write(f"{track_name} ~ Трек недоступен\n")
-                    self.mutex.release()
-                    self.not_downloaded_tracks += 1
-                    return True
+                    playlist.write_error(f"{track_name} ~ Трек недоступен")
+                    playlist.count_failure()
+                    self._discard_prefetched(playlist, track_data)
+                    return None
 
-                def _error_func():
-                    self.not_downloaded_tracks += 1
-                    self.mutex.acquire()
-                    with open(f"{self.download_folder_path}/info/errors.txt", 'a', encoding='utf-8') as file1:
-                        file1.write(f"Не удалось обновить метаданные для файла [{full_track_name}].\n")
-                    self.mutex.release()
-                    logger.error(f'Не удалось обновить метаданные для файла [{full_track_name}].')
+                return self._get_download_info(playlist, track_data)
 
-                # Пытаемся найти данных трек с разными доступными кодеками
-                for info in sorted(track_data['track'].get_download_info(), key=lambda x: x['bitrate_in_kbps'], reverse=True):
-                    codec = info.codec
-                    full_track_name = os.path.abspath(f'{self.download_folder_path}/{track_name}.{codec}')
+            def _get_download_info(self, playlist, track_data):
+                """
+                Забирает заранее полученные варианты загрузки трека, либо запрашивает их
 
-                    # Если трек существует, обновляем метаданные
-                    if os.path.exists(full_track_name):
-                        logger.debug(f'Трек [{track_name}] присутствует на диске '
-                                     f'[{self.download_folder_path}]. Пытаюсь обновить метаданные.')
+                :param playlist: плейлист трека
+                :param track_data: текущий трек
+                :return: список вариантов загрузки в порядке политики качества плейлиста
+                """
+                if self._prefetcher is not None:
+                    download_info = self._prefetcher.get(self.get_prefetch_key(playlist, track_data),
+                                                         playlist, track_data)
+                    if download_info is not None:
+                        return download_info
+                return self.resolve_download_info(playlist, track_data)
+
+            def _get_quality_upgrade(self, playlist, track_data, track_name):
+                """
+                Проверяет, записан ли трек в базе в худшем варианте, чем выбрал бы сейчас политика качества плейлиста.
+                Если да, то трек отмечается для замены.
 
-                        cover_filename = os.path.abspath(f'{self.download_folder_path}/covers/{track_name}.png')
-                        if not os.path.exists(cover_filename):
-                            logger.debug(f'Обложка для трека [{track_name}] не найдена, начинаю загрузку.')
-                            try:
-                                track_data['track'].download_cover(cover_filename, size="300x300")
-                                logger.debug(f'Обложка для трека [{track_name}] была скачана в [{cover_filename}].')
-                            except AttributeError:
-                                logger.debug(f"Обложки для трека [{track_name}] не существует, создаю стандартную.")
-                                self._create_cover(cover_filename)
-                                logger.debug(f'Стандартная обложка для трека [{track_name}] была создана в [{cover_filename}].')
-                        try:
-                            track_metadata = self._get_track_metadata(track_data)
-                            self._write_track_metadata(full_track_name=full_track_name,
-                                                        track_title=track_metadata['title'],
-                                                        artists=track_metadata['artists'],
-                                                        albums=track_metadata['albums'],
-                                                        genre=track_metadata['genre'],
-                                                        album_artists=track_metadata['album_artists'],
-                                                        year=track_metadata['year'],
-                                                        cover_filename=cover_filename,
-                                                        track_position=track_metadata['track_number'],
+                :param playlist: плейлист трека
+                :param track_data: текущий трек
+                :param track_name: имя трека
+                :return: варианты загрузки, если трек нужно перекачать, иначе None
+                """
+                recorded_quality = self._get_track_quality_in_database(playlist, track_data)
+                if recorded_quality is None:
+                    return None
+
+                download_info = self._get_download_info(playlist, track_data)
+                recorded_codec, recorded_bitrate = recorded_quality
+                if not download_info or not playlist.quality_policy.is_better(download_info[0], recorded_codec,
+                                                                              recorded_bitrate):
+                    return None
+
+                logger.debug(f'Трек [{track_name}] записан в базе с кодеком [{recorded_codec}] и битрейтом '
+                             f'[{recorded_bitrate}], по политике качества нужен [{download_info[0].codec}] '
+                             f'[{download_info[0].bitrate_in_kbps}]. Перекачиваю.')
+                playlist.mark_upgrade(track_data['id'], recorded_codec)
+                return download_info
+
+            def _is_rewritable(self, playlist, track_data) -> bool:
+                """
+                Нужно ли перезаписать трек, если он уже есть на диске
+
+                :param playlist: плейлист трека
+                :param track_data: текущий трек
+                :return:
+                """
+                return self.special_modes[config.Actions.check_actions['rw']] or playlist.is_upgrade(track_data['id'])
+
+            def resolve_download_info(self, playlist, track_data):
+                """
+                Получает варианты загрузки трека в порядке политики качества плейлиста. Для скачивания сразу получает
+                и прямую ссылку на первый вариант, чтобы передача могла начаться без лишнего запроса.
+
+                :param playlist: плейлист трека
+                :param track_data: текущий трек
+                :return: список вариантов загрузки от предпочтительного к запасным
+                """
+                download_info = playlist.quality_policy.order(self._request(track_data['track'].get_download_info))
+                if download_info and self.action_type == 'd':
+                    self._request(download_info[0].get_direct_link)
+                return download_info
+
+            def prefetch_download_info(self, playlist, track_data):
+                """
+                Заранее получает варианты загрузки трека, который ещё стоит в очереди (вызывается из pool.Prefetcher)
+
+                :param playlist: плейлист трека
+                :param track_data: текущий трек
+                :return: список вариантов загрузки, либо None, если трек скачивать не нужно
+                """
+                if not track_data['track'].available:
+                    return None
+                if self.special_modes[config.Actions.check_actions['hist']] and not config.QUALITY_UPGRADE_ON_SYNC and \
+                        self._is_track_in_database(playlist, track_data):
+                    return None
+                return self.resolve_download_info(playlist, track_data)
+
+            @staticmethod
+            def estimate_transfer_size(track_data) -> int:
+                """
+                Оценка размера трека в байтах для упорядочивания очереди. Если размер файла неизвестен,
+                то он оценивается по длительности трека при битрейте 320 кбит/с.
+
+                :param track_data: текущий трек
+                :return:
+                """
+                track = track_data['track']
+                file_size = getattr(track, 'file_size', None)
+                if file_size:
+                    return file_size
+                return (getattr(track, 'duration_ms', None) or 0) * 320 // 8
+
+            @staticmethod
+            def get_prefetch_key(playlist, track_data):
+                return id(playlist), track_data['id']
+
+            def _discard_prefetched(self, playlist, track_data):
+                if self._prefetcher is not None:
+                    self._prefetcher.discard(self.get_prefetch_key(playlist, track_data))
+
+            def _register_existing_track(self, playlist, track_data, track_name, codec, bitrate):
+                """
+                Добавляет в базу данных трек, который уже есть на диске, если его там нет
+
+                :param playlist: плейлист трека
+                :param track_data: текущий трек
+                :param track_name: имя трека
+                :param codec: кодек трека
+                :param bitrate: битрейт трека
+                :return:
+                """
+                logger.debug(f'Трек [{track_name}] уже существует на диске '
+                             f'[{playlist.download_folder_path}]. Проверяю в базе.')
+
+                if self._is_track_in_database(playlist, track_data):
+                    logger.debug(f'Трек [{track_name}] уже существует в базе '
+                                 f'[{self.history_database_path}]. Так как отключена перезапись, выхожу.')
+                else:
+                    logger.debug(f'Трек [{track_name}] отсутствует в базе '
+                                 f'[{self.history_database_path}]. Так как отключена перезапись, просто '
+                                 f'добавляю его в базу и выхожу.')
+                    self.__add_track_to_database(playlist=playlist,
+                                                 track_data=track_data,
+                                                 codec=codec,
+                                                 bit_rate=bitrate,
+                                                 is_favorite=self._is_favorite_track(track_data['id'])
+                                                 )
+                    logger.debug(
+                        f'Трек [{track_name}] был добавлен в базу данных [{self.history_database_path}].')
+
+            def _finish_track_download(self, playlist, track_data, track_name, full_track_name, cover_filename,
+                                       codec, bitrate):
+                """
+                Завершает загрузку трека: записывает метаданные в файл и добавляет трек в базу данных
+
+                :param playlist: плейлист трека
+                :param track_data: текущий трек
+                :param track_name: имя трека
+                :param full_track_name: путь к скачанному треку
+                :param cover_filename: путь к обложке трека
+                :param codec: кодек трека
+                :param bitrate: битрейт трека
+                :return:
+                """
+                track_metadata = self._write_track_tags(track_data, track_name, full_track_name, cover_filename)
+                self._record_track_download(playlist, track_data, track_name, codec, bitrate, track_metadata)
+
+            def _fetch_track_cover(self, track_data, track_name, cover_filename):
+                """
+                Скачивает обложку трека, если её ещё нет на диске. Если у трека нет обложки, то создаёт стандартную.
+
+                :param track_data: текущий трек
+                :param track_name: имя трека
+                :param cover_filename: путь к обложке трека
+                :return:
+                """
+                if os.path.exists(cover_filename):
+                    return
+
+                logger.debug(f'Обложка для трека [{track_name}] не найдена, начинаю загрузку.')
+                try:
+                    self._request(network.download_file, self._get_cover_url(track_data), cover_filename,
+                                  cancel_token=self._cancel_token, throttle=self._bandwidth_share)
+                    logger.debug(f'Обложка для трека [{track_name}] была скачана в [{cover_filename}].')
+                except AttributeError:
+                    logger.debug(f"Обложки для трека [{track_name}] не существует, создаю стандартную.")
+                    self._create_cover(cover_filename)
+                    logger.debug(f'Стандартная обложка для трека [{track_name}] была создана в [{cover_filename}].')
+
+            def _download_audio(self, info, full_track_name, track_id):
+                """
+                Скачивает трек. Если тот же трек в том же варианте сейчас качается в другой вкладке или плейлисте,
+                то дожидается той загрузки и копирует её файл (см. network.TransferRegistry).
+                Если включено общее хранилище, то трек качается в него (только если его там ещё нет),
+                а в папку плейлиста попадает ссылка на файл хранилища.
+
+                :param info: вариант загрузки трека
+                :param full_track_name: путь, куда сохранить трек
+                :param track_id: id трека
+                :return:
+                """
+                registry = network.get_transfer_registry()
+
+                def transfer(filename):
+                    started_at = time.monotonic()
+                    self._transfer_audio(info, filename)
+                    self._record_transfer(started_at, filename)
+
+                try:
+                    if self._content_store is None:
+                        registry.download(self.get_transfer_key(track_id, info), full_track_name, transfer,
+                                          self._cancel_token)
+                        return
+
+                    store_filename = self._content_store.get_filename(track_id, info.codec, info.bitrate_in_kbps)
+                    if os.path.exists(store_filename):
+                        logger.debug(f'Трек [{full_track_name}] уже есть в хранилище [{store_filename}].')
+                    else:
+                        registry.download(self.get_transfer_key(track_id, info), store_filename, transfer,
+                                          self._cancel_token)
+                    self._content_store.link(store_filename, full_track_name)
+                finally:
+                    info.direct_link = None
+
+            def _transfer_audio(self, info, full_track_name):
+                """
+                Скачивает трек во временный .part файл с докачкой и переименовывает его после полной загрузки.
+                Временный файл помечается битрейтом, чтобы не докачивать один вариант трека данными другого.
+                Если одновременно качается мало треков, то большой файл качается по частям в несколько соединений,
+                иначе слишком долгая загрузка подстраховывается второй (см. network.download_file_hedged).
+
+                :param info: вариант загрузки трека
+                :param full_track_name: путь, куда сохранить трек
+                :return:
+                """
+                # Прямая ссылка могла быть получена заранее. Она используется только для первой попытки,
+                # повторы запрашивают свежую ссылку
+                direct_link = info.direct_link or info.get_direct_link()
+                part_filename = network.get_part_filename(full_track_name, info.bitrate_in_kbps)
+
+                if config.SEGMENTED_DOWNLOAD and self._concurrency.active <= config.SEGMENTED_DOWNLOAD_MAX_ACTIVE:
+                    # Каждая часть сверх первой занимает свои слоты вкладки и общего ограничения
+                    extra_slots = self._acquire_extra_slots(config.SEGMENTED_DOWNLOAD_CONNECTIONS - 1)
+                    try:
+                        network.download_file_segmented(direct_link, full_track_name, part_filename=part_filename,
+                                                        number_of_segments=1 + extra_slots,
+                                                        watchdog=self._watchdog, throttle=self._bandwidth_share,
+                                                        cancel_token=self._cancel_token)
+                    finally:
+                        self._release_extra_slots(extra_slots)
+                else:
+                    network.download_file_hedged(direct_link, info.get_direct_link, full_track_name,
+                                                 part_filename=part_filename,
+                                                 latency_tracker=self._latency_tracker,
+                                                 watchdog=self._watchdog, throttle=self._bandwidth_share,
+                                                 cancel_token=self._cancel_token,
+                                                 acquire_slot=lambda: self._acquire_extra_slots(1) == 1,
+                                                 release_slot=lambda: self._release_extra_slots(1))
+
+            def _acquire_extra_slots(self, number_of_slots):
+                """
+                Без ожидания занимает дополнительные слоты контроллера вкладки и общего планировщика
+
+                :param number_of_slots: сколько слотов нужно
+                :return: сколько слотов удалось занять
+                """
+                for i in range(number_of_slots):
+                    if not self._concurrency.try_acquire():
+                        return i
+                    if not self._fair_job.try_acquire():
+                        self._concurrency.release()
+                        return i
+                return number_of_slots
+
+            def _release_extra_slots(self, number_of_slots):
+                for _ in range(number_of_slots):
+                    self._fair_job.release()
+                    self._concurrency.release()
+
+            def _record_transfer(self, started_at, filename):
+                """
+                Сообщает контроллеру вкладки длительность и размер завершённой загрузки. Копии чужих загрузок
+                и треки, уже лежащие на диске, не учитываются, чтобы не искажать задержку.
+
+                :param started_at: время начала загрузки (time.monotonic)
+                :param filename: путь к скачанному файлу
+                :return:
+                """
+                self._concurrency.record(time.monotonic() - started_at, os.path.getsize(filename))
+
+            @staticmethod
+            def get_transfer_key(track_id, info):
+                # Битрейт в ключе, так как у плейлистов с разными политиками качества вариант с тем же кодеком
+                # может отличаться битрейтом
+                return track_id, info.codec, info.bitrate_in_kbps
+
+            @staticmethod
+            def _get_cover_url(track_data, size='300x300'):
+                """
+                Ссылка на обложку трека
+
+                :param track_data: текущий трек
+                :param size: размер обложки
+                :return:
+                """
+                return f'https://{track_data["track"].cover_uri.replace("%%", size)}'
+
+            def _write_track_tags(self, track_data, track_name, full_track_name, cover_filename):
+                """
+                Получает метаданные трека и записывает их в файл
+
+                :param track_data: текущий трек
+                :param track_name: имя трека
+                :param full_track_name: путь к скачанному треку
+                :param cover_filename: путь к обложке трека
+                :return: словарь метаданных, либо None, если их не удалось получить
+                """
+                # Файлы папок плейлистов могут быть ссылками на один файл хранилища, поэтому теги пишутся по очереди
+                file_lock = self._content_store.lock(full_track_name) if self._content_store is not None \
+                    else contextlib.nullcontext()
+                try:
+                    track_metadata = self._get_track_metadata(track_data)
+                    with file_lock:
+                        self._check_cancelled(full_track_name)
+                        self._write_track_metadata(full_track_name=full_track_name,
+                                                   track_title=track_metadata['title'],
+                                                   artists=track_metadata['artists'],
+                                                   albums=track_metadata['albums'],
+                                                   genre=track_metadata['genre'],
+                                                   album_artists=track_metadata['album_artists'],
+                                                   year=track_metadata['year'],
+                                                   cover_filename=cover_filename,
+                                                   track_position=track_metadata['track_number'],
+                                                   disk_number=track_metadata['disk_number'],
+                                                   lyrics=track_metadata['lyrics'])
+                    logger.debug(f'Метаданные трека [{track_name}] были обновлены.')
+                    return track_metadata
+                except AttributeError:
+                    logger.error(f'Не удалось обновить метаданные для файла [{full_track_name}].')
+                except TypeError:
+                    logger.error(f'Не удалось обновить метаданные для файла [{full_track_name}].')
+                return None
+
+            def _check_cancelled(self, full_track_name):
+                """
+                Если вкладка остановлена, то удаляет скачанный, но ещё не обработанный трек (иначе при следующей
+                загрузке он был бы пропущен без тегов) и прерывает обработку
+
+                :param full_track_name: путь к скачанному треку
+                :return:
+                """
+                if self._cancel_token is None or not self._cancel_token.is_cancelled():
+                    return
+
+                if os.path.exists(full_track_name):
+                    os.remove(full_track_name)
+                raise network.DownloadCancelledError(f'Обработка трека [{full_track_name}] отменена.')
+
+            def _record_track_download(self, playlist, track_data, track_name, codec, bitrate, track_metadata=None):
+                """
+                Отмечает трек скачанным и добавляет его в базу данных, если его там нет
+
+                :param playlist: плейлист трека
+                :param track_data: текущий трек
+                :param track_name: имя трека
+                :param codec: кодек трека
+                :param bitrate: битрейт трека
+                :param track_metadata: уже полученные метаданные трека (чтобы не запрашивать их повторно)
+                :return:
+                """
+                playlist.write_downloaded(track_name)
+
+                if not self._is_track_in_database(playlist, track_data):
+                    logger.debug(f'Трек [{track_name}] отсутствует в базе данных по пути '
+                                 f'[{self.history_database_path}]. Добавляю в базу.')
+                    self.__add_track_to_database(playlist=playlist,
+                                                 track_data=track_data,
+                                                 codec=codec,
+                                                 bit_rate=bitrate,
+                                                 is_favorite=self._is_favorite_track(track_data['id']),
+                                                 track_metadata=track_metadata
+                                                 )
+                    logger.debug(
+                        f'Трек [{track_name}] был добавлен в базу данных [{self.history_database_path}].')
+                else:
+                    logger.debug(f'Трек [{track_name}] уже присутствует в базе данных по пути '
+                                 f'[{self.history_database_path}]. Обновляю кодек и битрейт.')
+                    # Трек мог быть перекачан в другом варианте, поэтому записываем кодек и битрейт скачанного файла
+                    self._update_track_quality_in_database(playlist, track_data, codec, bitrate)
+
+                # Если трек перекачан по политике качества с другим кодеком, то удаляем файл с прежним кодеком
+                replaced_codec = playlist.pop_upgrade(track_data['id'])
+                replaced_filename = f'{playlist.download_folder_path}/{track_name}.{replaced_codec}'
+                if replaced_codec is not None and replaced_codec != codec and os.path.exists(replaced_filename):
+                    os.remove(replaced_filename)
+                    logger.debug(f'Файл [{replaced_filename}] заменён вариантом с кодеком [{codec}].')
+
+                playlist.count_success()
+
+            def _request(self, func, *args, **kwargs):
+                """
+                Выполняет сетевой запрос с повторами при временных ошибках
+
+                :param func: функция запроса
+                :return: результат функции
+                """
+                return self._retry_policy.call(func, *args, **kwargs)
+
+            def _report_network_failure(self, playlist, track_data, error):
+                """
+                Отмечает трек, который не удалось обработать из-за ошибки сети даже после всех повторов
+
+                :param playlist: плейлист трека
+                :param track_data: текущий трек
+                :param error: исключение
+                :return:
+                """
+                if self._close_worker:
+                    return
+
+                track_name = self._get_track_name(track_data)
+                logger.error(f'Не удалось связаться с сервисом Яндекс Музыка при обработке трека [{track_name}]: {error}')
+                playlist.write_error(f"{track_name} ~ Ошибка сети")
+                playlist.count_failure()
+                playlist.track_done()
+
+            def _requeue_stalled_track(self, playlist, track_data):
+                """
+                Возвращает трек с зависшей загрузкой в очередь вкладки, чтобы его подхватил свободный воркер.
+                Если загрузка трека зависает слишком часто, то трек отмечается необработанным.
+
+                :param playlist: плейлист трека
+                :param track_data: текущий трек
+                :return:
+                """
+                if self._close_worker:
+                    return
+
+                track_name = self._get_track_name(track_data)
+                if playlist.count_stall(track_data['id']) > config.STALL_MAX_REQUEUES:
+                    logger.error(f'Загрузка трека [{track_name}] зависала слишком часто.')
+                    playlist.write_error(f"{track_name} ~ Загрузка трека зависла")
+                    playlist.count_failure()
+                    playlist.track_done()
+                    return
+
+                logger.warning(f'Загрузка трека [{track_name}] зависла, возвращаю трек в очередь.')
+                self.tracks_queue.put((playlist, track_data))
+
+            def _report_failed_download(self, playlist, track_name):
+                """
+                Отмечает трек, который не удалось скачать ни с одним кодеком
+
+                :param playlist: плейлист трека
+                :param track_name: имя трека
+                :return:
+                """
+                logger.error(f'Не удалось скачать трек [{track_name}].')
+                playlist.write_error(f"{track_name} ~ Не удалось скачать трек")
+                playlist.count_failure()
+
+            def _update_track_metadata(self, playlist, track_data):
+                """
+                Обновляет метаданные трека
+
+                :param playlist: плейлист трека
+                :param track_data: текущий трек
+                :return:
+                """
+                track_name = self._get_track_name(track_data)
+
+                if self._close_worker is True:
+                    return False
+
+                if not track_data['track'].available:
+                    logger.error(f'Трек [{track_name}] недоступен.')
+                    playlist.write_error(f"{track_name} ~ Трек недоступен")
+                    playlist.count_failure()
+                    return True
+
+                def _error_func():
+                    playlist.count_failure()
+                    playlist.write_error(f"Не удалось обновить метаданные для файла [{full_track_name}].")
+                    logger.error(f'Не удалось обновить метаданные для файла [{full_track_name}].')
+
+                # Пытаемся найти данных трек с разными доступными кодеками
+                for info in sorted(self._request(track_data['track'].get_download_info), key=lambda x: x['bitrate_in_kbps'], reverse=True):
+                    codec = info.codec
+                    full_track_name = os.path.abspath(f'{playlist.download_folder_path}/{track_name}.{codec}')
+
+                    # Если трек существует, обновляем метаданные
+                    if os.path.exists(full_track_name):
+                        logger.debug(f'Трек [{track_name}] присутствует на диске '
+                                     f'[{playlist.download_folder_path}]. Пытаюсь обновить метаданные.')
+
+                        cover_filename = os.path.abspath(f'{playlist.download_folder_path}/covers/{track_name}.png')
+                        self._fetch_track_cover(track_data, track_name, cover_filename)
+                        try:
+                            track_metadata = self._get_track_metadata(track_data)
+                            self._write_track_metadata(full_track_name=full_track_name,
+                                                        track_title=track_metadata['title'],
+                                                        artists=track_metadata['artists'],
+                                                        albums=track_metadata['albums'],
+                                                        genre=track_metadata['genre'],
+                                                        album_artists=track_metadata['album_artists'],
+                                                        year=track_metadata['year'],
+                                                        cover_filename=cover_filename,
+                                                        track_position=track_metadata['track_number'],
                                                         disk_number=track_metadata['disk_number'],
                                                         lyrics=track_metadata['lyrics'])
                             logger.debug(f'Метаданные трека [{track_name}] были обновлены.')
-                            self.downloaded_tracks += 1
+                            playlist.count_success()
                         except AttributeError:
                             _error_func()
                         except TypeError:
@@ -2483,10 +3275,11 @@ class YandexMusicDownloader:
                         break
                 return True
 
-            def _add_track_to_database(self, track_data):
+            def _add_track_to_database(self, playlist, track_data):
                 """
                 Добавляет текущий трек в базу данных, если его там нет
 
+                :param playlist: плейлист трека
                 :param track_data: текущий трек
                 :return:
                 """
@@ -2497,43 +3290,39 @@ class YandexMusicDownloader:
 
                 if not track_data['track'].available:
                     logger.error(f'Трек [{track_name}] недоступен.')
-                    self.mutex.acquire()
-                    with open(f"{self.download_folder_path}/info/errors.txt", 'a', encoding='utf-8') as file:
-                        file.write(f"{track_name} ~ Трек недоступен\n")
-                    self.mutex.release()
-                    self.not_downloaded_tracks += 1
+                    playlist.write_error(f"{track_name} ~ Трек недоступен")
+                    playlist.count_failure()
                     return True
 
-                if not self._is_track_in_database(track_data):
-                    info = sorted(track_data['track'].get_download_info(), key=lambda x: x['bitrate_in_kbps'], reverse=True)[0]
+                if not self._is_track_in_database(playlist, track_data):
+                    info = playlist.quality_policy.order(self._request(track_data['track'].get_download_info))[0]
                     codec = info.codec
                     bitrate = info.bitrate_in_kbps
 
                     logger.debug(f'Трек [{track_name}] отсутствует в базе [{self.history_database_path}].')
                     ret_value = self.__add_track_to_database(
+                        playlist=playlist,
                         track_data=track_data,
                         codec=codec,
                         bit_rate=bitrate,
                         is_favorite=self._is_favorite_track(track_data['id'])
                     )
                     if ret_value:
-                        self.downloaded_tracks += 1
+                        playlist.count_success()
                         logger.debug(f'Трек [{track_name}] был добавлен в базу данных [{self.history_database_path}].')
                     else:
-                        self.not_downloaded_tracks += 1
-                        self.mutex.acquire()
-                        with open(f"{self.download_folder_path}/info/errors.txt", 'a', encoding='utf-8') as file:
-                            file.write(f"Трек [{track_name}] не удалось добавить в базу данных [{self.history_database_path}].\n")
-                        self.mutex.release()
+                        playlist.count_failure()
+                        playlist.write_error(f"Трек [{track_name}] не удалось добавить в базу данных [{self.history_database_path}].")
                 else:
                     logger.debug(f'Трек [{track_name}] уже существует в базе [{self.history_database_path}].')
                 return True
 
-            def _get_track_metadata(self, track_data):
+            def _get_track_metadata(self, track_data, with_lyrics=True):
                 """
                 Получаем метаданные трека
 
                 :param track_data: текущий трек
+                :param with_lyrics: запрашивать ли текст песни (отдельный запрос, в базу данных он не записывается)
                 :return: Словарь метаданных
                 """
 
@@ -2559,7 +3348,7 @@ class YandexMusicDownloader:
                 artist_id = ', '.join(str(i.id) for i in track_data['track'].artists)
                 album_id = ', '.join(str(i.id) for i in track_data['track'].albums)
 
-                lyrics = track_data['track'].get_supplement().lyrics
+                lyrics = self._request(track_data['track'].get_supplement).lyrics if with_lyrics else None
                 lyrics = track_metadata.lyricist if lyrics is None and track_metadata is not None else lyrics
 
                 release_data = album_info.release_date if album_info is not None else ""
@@ -2606,96 +3395,199 @@ class YandexMusicDownloader:
                     return utils.strip_bad_symbols(_track_name, soft_mode=True)
                 return _track_name
 
-            def _is_track_in_database(self, track_data):
+            def _is_track_in_database(self, playlist, track_data):
                 """
                 Ищет трек в базе данных
 
+                :param playlist: плейлист трека
                 :param track_data: трек
                 :return: True - если нашел, False - если нет.
                 """
-                _playlist_name = f'table_{self.playlist_title}'
                 _track_name = self._get_track_name(track_data)
 
                 logger.debug(f'Ищу трек [{_track_name}] в базе [{self.history_database_path}].')
                 try:
-                    with sqlite3.connect(self.history_database_path) as con:
-                        cursor = con.cursor()
-                        request = f"SELECT * FROM {_playlist_name} WHERE track_id == ? " \
-                                  f"OR (track_name == ? " \
-                                  f"AND artist_name == ?);"
-                        result = cursor.execute(request, [track_data['id'], track_data['title'], track_data['artists']])
-                        return True if result.fetchone() else False
+                    return self._history.get_known_tracks(playlist.table_title).contains(
+                        track_data['id'], track_data['title'], track_data['artists'])
                 except sqlite3.Error:
                     logger.error(f'Трек [{_track_name}] не удалось проверить в базе данных!')
                     return False
 
-            def __add_track_to_database(self, track_data, codec, bit_rate, is_favorite):
+            def _get_track_quality_in_database(self, playlist, track_data):
+                """
+                Получает кодек и битрейт, с которыми трек записан в базе данных
+
+                :param playlist: плейлист трека
+                :param track_data: трек
+                :return: (кодек, битрейт), либо None, если трека нет в базе
+                """
+                _track_name = self._get_track_name(track_data)
+
+                try:
+                    return self._history.get_quality(playlist.table_title, track_data['id'], track_data['title'],
+                                                     track_data['artists'])
+                except sqlite3.Error:
+                    logger.error(f'Кодек и битрейт трека [{_track_name}] не удалось получить из базы данных!')
+                    return None
+
+            def _update_track_quality_in_database(self, playlist, track_data, codec, bit_rate):
+                """
+                Записывает в базу данных кодек и битрейт скачанного трека
+
+                :param playlist: плейлист трека
+                :param track_data: трек
+                :param codec: кодек трека
+                :param bit_rate: битрейт трека
+                :return:
+                """
+                _track_name = self._get_track_name(track_data)
+
+                try:
+                    self._history.update_quality(playlist.table_title, track_data['id'], track_data['title'],
+                                                 track_data['artists'], codec, bit_rate)
+                except sqlite3.Error:
+                    logger.error(f'Кодек и битрейт трека [{_track_name}] не удалось обновить в базе данных!')
+
+            def __add_track_to_database(self, playlist, track_data, codec, bit_rate, is_favorite, track_metadata=None):
                 """
                 Добавляет трек в базу данных
 
+                :param playlist: плейлист трека
                 :param track_data: трек
                 :param codec: кодек трека
                 :param bit_rate: битрейт трека
                 :param is_favorite: любимый ли это трек
+                :param track_metadata: уже полученные метаданные трека (если None, то будут запрошены)
 
                 :return: True - если все хорошо
                 """
-                _playlist_name = f'table_{self.playlist_title}'
                 _track_name = self._get_track_name(track_data)
 
                 logger.debug(f'Добавляю трек [{_track_name}] в базу [{self.history_database_path}].')
 
-                con = None
-                metadata = []
-                return_val = True
+                track = {}
                 try:
-                    con = sqlite3.connect(self.history_database_path)
-                    cursor = con.cursor()
-                    request = f"INSERT INTO {_playlist_name}(" \
-                              f"track_id, artist_id, album_id, track_name, artist_name, album_name, genre, track_number, " \
-                              f"disk_number, year, release_data, bit_rate, codec, is_favorite, is_explicit, is_popular) " \
-                              f"VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?);"
-
-                    track_metadata = self._get_track_metadata(track_data)
+                    if track_metadata is None:
+                        track_metadata = self._get_track_metadata(track_data)
 
-                    track_id = track_metadata['id']
-                    artist_id = track_metadata['artist_id']
-                    album_id = track_metadata['album_id']
-                    track_name = track_metadata['title']
-                    artist_name = track_metadata['artists']
-                    album_name = track_metadata['albums']
-                    
-                    genre = track_metadata['genre']
-                    track_number = track_metadata['track_number']
-                    disk_number = track_metadata['disk_number']
-                    year = track_metadata['year']
-
-                    release_data = track_metadata['release_data']
-                    is_explicit = track_metadata['is_explicit']
-                    is_popular = track_metadata['is_popular']
-
-                    metadata = [track_id, artist_id, album_id, track_name, artist_name, album_name,
-                                genre, track_number, disk_number, year, release_data, bit_rate, codec,
-                                is_favorite, is_explicit, is_popular]
-
-                    cursor.execute(request, metadata)
-                    con.commit()
+                    track = self._get_database_track(track_metadata, is_favorite)
+                    # Трек записывается потоком записи базы вместе с другими, ошибку записи он залогирует сам
+                    self._history.add_track(playlist.table_title, track, codec, bit_rate)
 
                 except AttributeError:
-                    return_val = False
                     logger.error(f'Проблемы с тегами.')
-                    if con is not None:
-                        con.rollback()
+                    return False
 
                 except sqlite3.Error:
-                    return_val = False
-                    logger.error(f'Не удалось выполнить SQL запрос вставки. Данные: [{metadata}].')
-                    if con is not None:
-                        con.rollback()
-                finally:
-                    if con is not None:
-                        con.close()
-                return return_val
+                    logger.error(f'Не удалось выполнить SQL запрос вставки. Данные: [{track}].')
+                    return False
+                return True
+
+            @staticmethod
+            def _get_database_track(track_metadata, is_favorite):
+                """
+                Значения столбцов таблицы треков в базе данных
+
+                :param track_metadata: метаданные трека
+                :param is_favorite: любимый ли это трек
+                :return:
+                """
+                return {
+                    'track_id': str(track_metadata['id']),
+                    'artist_id': track_metadata['artist_id'],
+                    'album_id': track_metadata['album_id'],
+                    'track_name': track_metadata['title'],
+                    'artist_name': track_metadata['artists'],
+                    'album_name': track_metadata['albums'],
+                    'genre': track_metadata['genre'],
+                    'track_number': track_metadata['track_number'],
+                    'disk_number': track_metadata['disk_number'],
+                    'year': track_metadata['year'],
+                    'release_data': track_metadata['release_data'],
+                    'is_favorite': is_favorite,
+                    'is_explicit': track_metadata['is_explicit'],
+                    'is_popular': track_metadata['is_popular']
+                }
+
+            def add_tracks_to_database(self, playlist, playlist_data):
+                """
+                Добавляет в базу данных все треки плейлиста, которых там ещё нет, одной транзакцией.
+                Отсутствующие треки определяются по загруженному один раз множеству треков плейлиста, варианты
+                загрузки для них запрашиваются параллельно пачками, а текст песни не запрашивается (в базу он
+                не записывается).
+
+                :param playlist: плейлист
+                :param playlist_data: треки плейлиста
+                :return:
+                """
+                known_tracks = self._history.get_known_tracks(playlist.table_title)
+                liked_ids = {str(track.id) for track in self.favorite_tracks}
+
+                successes = 0
+                failures = 0
+                missing_tracks = []
+                missing_ids = set()
+                for track_data in playlist_data:
+                    if not track_data['track'].available:
+                        track_name = self._get_track_name(track_data)
+                        logger.error(f'Трек [{track_name}] недоступен.')
+                        playlist.write_error(f"{track_name} ~ Трек недоступен")
+                        failures += 1
+                    elif not known_tracks.contains(track_data['id'], track_data['title'], track_data['artists']) \
+                            and track_data['id'] not in missing_ids:
+                        missing_tracks.append(track_data)
+                        missing_ids.add(track_data['id'])
+
+                def _get_best_info(_track_data):
+                    return playlist.quality_policy.order(self._request(_track_data['track'].get_download_info))[0]
+
+                rows = []
+                batch_size = max(1, config.BULK_INGEST_BATCH_SIZE)
+                with concurrent.futures.ThreadPoolExecutor(max_workers=self._concurrency.limit,
+                                                           thread_name_prefix='ymd-ingest') as executor:
+                    for start in range(0, len(missing_tracks), batch_size):
+                        if self._close_worker is True:
+                            return
+
+                        batch = missing_tracks[start:start + batch_size]
+                        for track_data, future in zip(batch, [executor.submit(_get_best_info, track_data)
+                                                              for track_data in batch]):
+                            track_name = self._get_track_name(track_data)
+                            try:
+                                info = future.result()
+                                track_metadata = self._get_track_metadata(track_data, with_lyrics=False)
+                            except (NetworkError, YandexMusicError) as e:
+                                logger.error(f'Не удалось получить данные трека [{track_name}]: {e}')
+                                playlist.write_error(f"{track_name} ~ Ошибка сети")
+                                failures += 1
+                                continue
+                            except IndexError:
+                                logger.error(f'У трека [{track_name}] нет вариантов загрузки.')
+                                playlist.write_error(f"{track_name} ~ Трек недоступен")
+                                failures += 1
+                                continue
+                            except AttributeError:
+                                logger.error(f'Проблемы с тегами трека [{track_name}].')
+                                playlist.write_error(f"Трек [{track_name}] не удалось добавить в базу данных "
+                                                     f"[{self.history_database_path}].")
+                                failures += 1
+                                continue
+
+                            rows.append((self._get_database_track(track_metadata, track_data['id'] in liked_ids),
+                                         info.codec, info.bitrate_in_kbps))
+
+                try:
+                    if rows:
+                        self._history.add_tracks(playlist.table_title, rows).result()
+                    successes += len(rows)
+                    logger.debug(f'В базу данных [{self.history_database_path}] добавлено треков плейлиста '
+                                 f'[{playlist.title}]: {len(rows)}.')
+                except sqlite3.Error:
+                    logger.error(f'Не удалось добавить треки плейлиста [{playlist.title}] в базу данных '
+                                 f'[{self.history_database_path}].')
+                    playlist.write_error(f"Треки не удалось добавить в базу данных [{self.history_database_path}].")
+                    failures += len(rows)
+                playlist.complete(successes, failures)
 
             @staticmethod
             def _write_track_metadata(full_track_name, track_title, artists, albums, genre, album_artists, year,
@@ -2758,47 +3650,33 @@ class YandexMusicDownloader:
                         return True
                 return False
 
-            def _update_liked_track_in_database(self, track_data):
+            def _update_liked_track_in_database(self, playlist, track_data):
                 """
                 Обновляет список любимых треков в базе данных
 
+                :param playlist: плейлист трека
                 :param track_data: трек
                 :return:
                 """
                 _track_name = self._get_track_name(track_data)
-                _playlist_name = f'table_{self.playlist_title}'
 
                 _is_favorite = self._is_favorite_track(track_data['id'])
 
-                con = None
-                request = ''
-                return_value = True
-
                 try:
-                    if not self._is_track_in_database(track_data):
+                    if not self._is_track_in_database(playlist, track_data):
                         logger.debug(f"Трека [{_track_name}] нет в базе данных!")
-                        self.not_downloaded_tracks += 1
+                        playlist.count_failure()
                         return True
 
-                    con = sqlite3.connect(self.history_database_path)
-                    cursor = con.cursor()
-                    request = f"UPDATE {_playlist_name} SET is_favorite = ? WHERE track_id == ?;"
-                    cursor.execute(request, [_is_favorite, track_data['id']])
-                    con.commit()
+                    self._history.set_favorite(track_data['id'], _is_favorite)
 
                     logger.debug(f'Трек [{_track_name}] был добавлен в любимые.')
-                    self.downloaded_tracks += 1
+                    playlist.count_success()
                 except sqlite3.Error:
-                    self.not_downloaded_tracks += 1
-                    return_value = False
-                    logger.error(f'Не удалось выполнить SQL запрос обновления. Запрос: [{request}].')
-
-                    if con is not None:
-                        con.rollback()
-                finally:
-                    if con is not None:
-                        con.close()
-                return return_value
+                    playlist.count_failure()
+                    logger.error(f'Не удалось обновить отметку любимого трека [{_track_name}] в базе данных.')
+                    return False
+                return True
 
             def _create_cover(self, path, size=(300, 300)):
                 # Создайте новое изображение размером 300x300 пикселей и синим фоном
@@ -2813,4 +3691,481 @@ class YandexMusicDownloader:
                 draw.rectangle(square_coords, fill=square_color)
 
                 # Сохраните изображение
-                image.save(path)
\ No newline at end of file
+                image.save(path)
+
+        class AsyncDownloaderHelper(DownloaderHelper):
+            """
+            Воркер asyncio движка: забирает треки из общей очереди и обрабатывает их корутинами в event loop'е движка.
+            Передача данных идёт через aiohttp, а блокирующие шаги выполняются в пуле потоков движка.
+            """
+
+            def __init__(self, tracks_queue, action_type, special_modes):
+                super().__init__(tracks_queue, action_type, special_modes)
+
+                self._engine = engine.get_engine()
+
+            def run(self):
+                """
+                Основной метод работы воркера
+
+                :return:
+                """
+                while not self._close_worker:
+                    data = self.tracks_queue.get()
+                    if data is pool.TaskQueue.STOP:
+                        logger.debug(f'Получен маркер завершения.')
+                        self.tracks_queue.task_done()
+                        break
+
+                    # Если стоим на паузе, то ждём её снятия
+                    self._resume_event.wait()
+
+                    # Ограничиваем количество одновременно обрабатываемых треков
+                    if not self._concurrency.acquire():
+                        self.tracks_queue.task_done()
+                        break
+                    if self._close_worker or not self._fair_job.acquire():
+                        self._concurrency.release()
+                        self.tracks_queue.task_done()
+                        break
+
+                    self._state_working = True
+                    playlist, track_data = data
+                    future = self._engine.submit(self._async_do_work(playlist, track_data))
+                    with self._futures_lock:
+                        self._futures.add(future)
+                    future.add_done_callback(functools.partial(self._task_finished, playlist, track_data))
+
+                # Дожидаемся треков, которые ещё обрабатываются
+                with self._futures_lock:
+                    futures = list(self._futures)
+                concurrent.futures.wait(futures)
+                self._state_working = False
+
+            def close(self):
+                """
+                Сигнал на завершение работы для воркера. Отменяет все обрабатываемые треки.
+
+                :return:
+                """
+                super().close()
+                with self._futures_lock:
+                    futures = list(self._futures)
+                for future in futures:
+                    future.cancel()
+
+            def _task_finished(self, playlist, track_data, future):
+                """
+                Обработчик завершения корутины трека
+
+                :param playlist: плейлист трека
+                :param track_data: текущий трек
+                :param future: результат обработки трека
+                :return:
+                """
+                with self._futures_lock:
+                    self._futures.discard(future)
+                    if not self._futures:
+                        self._state_working = False
+                self._fair_job.release()
+                self._concurrency.release()
+
+                is_success = True
+                try:
+                    if future.result():
+                        playlist.track_done()
+                except concurrent.futures.CancelledError:
+                    pass
+                except network.DownloadCancelledError as e:
+                    logger.debug(f'Обработка трека прервана: {e}')
+                except (NetworkError, YandexMusicError) as e:
+                    is_success = False
+                    self._report_network_failure(playlist, track_data, e)
+                except Exception as e:
+                    logger.error(f'Ошибка при обработке трека: {e}')
+                    playlist.count_failure()
+                    playlist.track_done()
+                finally:
+                    if not is_success:
+                        self._concurrency.record_failure()
+                    self.tracks_queue.task_done()
+
+            async def _async_do_work(self, playlist, track_data):
+                """
+                В зависимости от экшена выполняем то или иное действие
+
+                :param playlist: плейлист трека
+                :param track_data: текущий трек
+                :return:
+                """
+                if self.action_type == 'd':
+                    return await self._async_download_track(playlist, track_data)
+                # Остальные действия не передают аудио, поэтому целиком выполняются в пуле потоков движка
+                return await self._engine.run_blocking(self._do_work, playlist, track_data)
+
+            async def _async_download_track(self, playlist, track_data):
+                """
+                Асинхронная версия _download_track: трек и обложка скачиваются через aiohttp
+
+                :param playlist: плейлист трека
+                :param track_data: текущий трек
+                :return: True - если все нормально скачалось
+                """
+                if self._close_worker is True:
+                    return False
+
+                track_name = self._get_track_name(track_data)
+
+                try:
+                    download_info = await self._engine.run_blocking(self._prepare_track_download, playlist,
+                                                                    track_data, track_name)
+                    if download_info is None:
+                        return True
+
+                    was_track_downloaded = False
+                    track_exists = False
+                    for info in download_info:
+                        codec = info.codec
+                        bitrate = info.bitrate_in_kbps
+                        full_track_name = os.path.abspath(f'{playlist.download_folder_path}/{track_name}.{codec}')
+
+                        if os.path.exists(f'{full_track_name}') and not self._is_rewritable(playlist, track_data):
+                            await self._engine.run_blocking(self._register_existing_track, playlist,
+                                                            track_data, track_name, codec, bitrate)
+                            track_exists = True
+                            break
+
+                        try:
+                            if self._close_worker is True:
+                                return False
+
+                            logger.debug(f'Начинаю загрузку трека [{track_name}].')
+                            await self._retry_policy.call_async(self._async_fetch_audio, info, full_track_name,
+                                                                track_data['id'])
+                            logger.debug(f'Трек [{track_name}] был скачан.')
+
+                            cover_filename = os.path.abspath(f'{playlist.download_folder_path}/covers/{track_name}.png')
+                            if not os.path.exists(cover_filename):
+                                logger.debug(f'Обложка для трека [{track_name}] не найдена, начинаю загрузку.')
+                                try:
+                                    await self._retry_policy.call_async(self._engine.download,
+                                                                        self._get_cover_url(track_data), cover_filename,
+                                                                        throttle=self._bandwidth_share,
+                                                                        cancel_token=self._cancel_token)
+                                    logger.debug(f'Обложка для трека [{track_name}] была скачана в [{cover_filename}].')
+                                except AttributeError:
+                                    logger.debug(f"Обложки для трека [{track_name}] не существует, создаю стандартную.")
+                                    await self._engine.run_blocking(self._create_cover, cover_filename)
+
+                            await self._engine.run_blocking(self._finish_track_download, playlist, track_data, track_name,
+                                                            full_track_name, cover_filename, codec, bitrate)
+                            was_track_downloaded = True
+                            break
+                        except (YandexMusicError, TimeoutError):
+                            logger.debug(
+                                f'Не удалось скачать трек [{track_name}] с кодеком [{codec}] и битрейтом [{bitrate}].')
+                            continue
+
+                    if was_track_downloaded is False and track_exists is False:
+                        await self._engine.run_blocking(self._report_failed_download, playlist, track_name)
+
+                except IOError:
+                    logger.error(f'Ошибка при попытке записи в файла.')
+                    playlist.count_failure()
+                return True
+
+            async def _async_fetch_audio(self, info, full_track_name, track_id):
+                """
+                Скачивает трек. Если включено общее хранилище, то трек качается в него (только если его там ещё нет),
+                а в папку плейлиста попадает ссылка на файл хранилища.
+
+                :param info: вариант загрузки трека
+                :param full_track_name: путь, куда сохранить трек
+                :param track_id: id трека
+                :return:
+                """
+                try:
+                    if self._content_store is None:
+                        await self._async_transfer_audio(info, full_track_name, track_id)
+                        return
+
+                    store_filename = self._content_store.get_filename(track_id, info.codec, info.bitrate_in_kbps)
+                    if os.path.exists(store_filename):
+                        logger.debug(f'Трек [{full_track_name}] уже есть в хранилище [{store_filename}].')
+                    else:
+                        await self._async_transfer_audio(info, store_filename, track_id)
+                    await self._engine.run_blocking(self._content_store.link, store_filename, full_track_name)
+                finally:
+                    info.direct_link = None
+
+            async def _async_transfer_audio(self, info, filename, track_id):
+                """
+                Получает прямую ссылку на трек и скачивает его. Заранее полученная ссылка используется только
+                для первой попытки, повторы запрашивают ссылку заново, так как она подписана и может устареть.
+                Если тот же трек в том же варианте уже качается, то дожидается той загрузки и копирует её файл.
+
+                :param info: вариант загрузки трека
+                :param filename: путь, куда сохранить трек
+                :param track_id: id трека
+                :return:
+                """
+                registry = network.get_transfer_registry()
+                key = self.get_transfer_key(track_id, info)
+
+                flight, is_leader = registry.join(key)
+                while not is_leader:
+                    # Ждём в event loop'е, а не в пуле потоков, чтобы ожидающие не заняли потоки, нужные ведущему
+                    try:
+                        while not flight.done.is_set():
+                            if self._cancel_token.is_cancelled():
+                                raise network.DownloadCancelledError(f'Ожидание загрузки [{filename}] отменено.')
+                            await asyncio.sleep(0.1)
+                    except BaseException:
+                        registry.leave(flight)
+                        raise
+                    if await self._engine.run_blocking(registry.copy, flight, filename):
+                        return
+                    flight, is_leader = registry.join(key)
+
+                try:
+                    direct_link = info.direct_link or await self._engine.run_blocking(info.get_direct_link)
+                    info.direct_link = None
+                    started_at = time.monotonic()
+                    await self._engine.download(direct_link, filename,
+                                                part_filename=network.get_part_filename(filename,
+                                                                                        info.bitrate_in_kbps),
+                                                throttle=self._bandwidth_share, cancel_token=self._cancel_token)
+                    self._record_transfer(started_at, filename)
+                except BaseException:
+                    registry.finish(key, flight)
+                    raise
+
+                # Ждём копирования в event loop'е: копии выполняются в том же пуле потоков, и ведущие, занявшие
+                # все его потоки ожиданием, не дали бы им выполниться
+                registry.finish(key, flight, filename, wait_readers=False)
+                while flight.readers:
+                    await asyncio.sleep(0.1)
+
+        class PipelineDownloaderHelper(DownloaderHelper):
+            """
+            Воркер конвейерного движка. Каждый трек проходит стадии: получение вариантов загрузки, скачивание аудио,
+            скачивание обложки, запись тегов и запись в базу данных. Стадии выполняются одновременно и не простаивают
+            друг из-за друга, а их задачи обрабатывает общий для всех вкладок пул потоков конвейерного движка.
+            """
+
+            def __init__(self, tracks_queue, action_type, special_modes):
+                super().__init__(tracks_queue, action_type, special_modes)
+
+                stages_workers = dict(config.PIPELINE_STAGES_WORKERS)
+                # При адаптивном режиме одновременно качают столько треков, сколько разрешает контроллер,
+                # поэтому ограничение стадии скачивания берём с запасом (потоков стадии не создают)
+                if config.ADAPTIVE_CONCURRENCY:
+                    stages_workers['audio'] = max(stages_workers['audio'], config.ADAPTIVE_MAX_WORKERS)
+
+                # Пул вмещает все одновременные скачивания движка и задачи остальных стадий одной вкладки
+                pool_size = (config.GLOBAL_MAX_ACTIVE_TASKS.get('pipeline') or config.ADAPTIVE_MAX_WORKERS) + \
+                    sum(workers for stage, workers in config.PIPELINE_STAGES_WORKERS.items() if stage != 'audio')
+
+                self._pipeline = pool.Pipeline(stages=[
+                    pool.Stage('resolve', self._stage_resolve, stages_workers['resolve'], config.PIPELINE_QUEUE_SIZE),
+                    pool.Stage('audio', self._stage_fetch_audio, stages_workers['audio'], config.PIPELINE_QUEUE_SIZE,
+                               acquire=self._acquire_audio_slot, release=self._release_audio_slot),
+                    pool.Stage('cover', self._stage_fetch_cover, stages_workers['cover'], config.PIPELINE_QUEUE_SIZE),
+                    pool.Stage('tag', self._stage_tag, stages_workers['tag'], config.PIPELINE_QUEUE_SIZE),
+                    pool.Stage('record', self._stage_record, stages_workers['record'], config.PIPELINE_QUEUE_SIZE),
+                ], on_done=self._track_finished, executor=pool.get_worker_pool('pipeline', pool_size))
+
+            def run(self):
+                """
+                Основной метод работы воркера: раздаёт треки из общей очереди в конвейер
+
+                :return:
+                """
+                self._pipeline.start()
+
+                while not self._close_worker:
+                    data = self.tracks_queue.get()
+                    if data is pool.TaskQueue.STOP:
+                        logger.debug(f'Получен маркер завершения.')
+                        self.tracks_queue.task_done()
+                        break
+
+                    # Если стоим на паузе, то ждём её снятия
+                    self._resume_event.wait()
+
+                    self._state_working = True
+                    playlist, track_data = data
+                    if not self._pipeline.put({'playlist': playlist, 'track_data': track_data}):
+                        self.tracks_queue.task_done()
+
+                self._pipeline.close()
+                self._state_working = False
+
+            def close(self):
+                """
+                Сигнал на завершение работы для воркера. Треки, которые ещё в конвейере, не обрабатываются.
+
+                :return:
+                """
+                super().close()
+                self._pipeline.cancel()
+
+            def pause(self):
+                super().pause()
+                self._pipeline.pause()
+
+            def resume(self):
+                super().resume()
+                self._pipeline.resume()
+
+            def _track_finished(self, item, error):
+                """
+                Обработчик выхода трека из конвейера
+
+                :param item: данные трека в конвейере
+                :param error: исключение, если трек упал с ошибкой
+                :return:
+                """
+                playlist = item['playlist']
+                try:
+                    if error is None:
+                        if not self._close_worker:
+                            playlist.track_done()
+                    elif isinstance(error, network.TransferStalledError):
+                        self._requeue_stalled_track(playlist, item['track_data'])
+                    elif isinstance(error, network.DownloadCancelledError):
+                        logger.debug(f'Обработка трека прервана: {error}')
+                    elif isinstance(error, (NetworkError, YandexMusicError)):
+                        self._report_network_failure(playlist, item['track_data'], error)
+                    elif isinstance(error, IOError):
+                        logger.error(f'Ошибка при попытке записи в файла.')
+                        playlist.count_failure()
+                        playlist.track_done()
+                    else:
+                        logger.error(f'Ошибка при обработке трека: {error}')
+                        playlist.count_failure()
+                        playlist.track_done()
+                finally:
+                    self.tracks_queue.task_done()
+
+            def _stage_resolve(self, item):
+                """
+                Стадия 1: проверка истории, доступности трека, наличия на диске и получение вариантов загрузки
+
+                :param item: данные трека в конвейере
+                :return: True - трек нужно скачивать
+                """
+                playlist, track_data = item['playlist'], item['track_data']
+                track_name = self._get_track_name(track_data)
+                item['track_name'] = track_name
+
+                download_info = self._prepare_track_download(playlist, track_data, track_name)
+                if download_info is None:
+                    return False
+
+                # Если трек с одним из кодеков уже есть на диске и мы не перезаписываем, то только проверяем его в базе
+                if not self._is_rewritable(playlist, track_data):
+                    for info in download_info:
+                        full_track_name = os.path.abspath(f'{playlist.download_folder_path}/{track_name}.{info.codec}')
+                        if os.path.exists(full_track_name):
+                            self._register_existing_track(playlist, track_data, track_name,
+                                                          info.codec, info.bitrate_in_kbps)
+                            return False
+
+                item['download_info'] = download_info
+                return True
+
+            def _stage_fetch_audio(self, item):
+                """
+                Стадия 2: скачивание аудио, начиная с лучшего варианта.
+                Количество одновременных скачиваний ограничивает контроллер вкладки (см. _acquire_audio_slot).
+
+                :param item: данные трека в конвейере
+                :return: True - трек скачан
+                """
+                try:
+                    return self._fetch_audio(item)
+                except (NetworkError, YandexMusicError):
+                    self._concurrency.record_failure()
+                    raise
+
+            def _acquire_audio_slot(self):
+                """
+                Ждёт слот контроллера вкладки и общего планировщика для скачивания аудио
+
+                :return: False - если вкладка завершается
+                """
+                if not self._concurrency.acquire():
+                    return False
+                if not self._fair_job.acquire():
+                    self._concurrency.release()
+                    return False
+                return True
+
+            def _release_audio_slot(self):
+                self._fair_job.release()
+                self._concurrency.release()
+
+            def _fetch_audio(self, item):
+                """
+                Скачивает аудио трека, перебирая варианты загрузки
+
+                :param item: данные трека в конвейере
+                :return: True - трек скачан
+                """
+                playlist, track_name = item['playlist'], item['track_name']
+
+                for info in item['download_info']:
+                    codec = info.codec
+                    bitrate = info.bitrate_in_kbps
+                    full_track_name = os.path.abspath(f'{playlist.download_folder_path}/{track_name}.{codec}')
+                    try:
+                        logger.debug(f'Начинаю загрузку трека [{track_name}].')
+                        self._request(self._download_audio, info, full_track_name, item['track_data']['id'])
+                        logger.debug(f'Трек [{track_name}] был скачан.')
+
+                        item['codec'] = codec
+                        item['bitrate'] = bitrate
+                        item['full_track_name'] = full_track_name
+                        return True
+                    except (YandexMusicError, TimeoutError):
+                        logger.debug(
+                            f'Не удалось скачать трек [{track_name}] с кодеком [{codec}] и битрейтом [{bitrate}].')
+
+                self._report_failed_download(playlist, track_name)
+                return False
+
+            def _stage_fetch_cover(self, item):
+                """
+                Стадия 3: скачивание обложки трека
+
+                :param item: данные трека в конвейере
+                :return: True
+                """
+                track_name = item['track_name']
+                item['cover_filename'] = os.path.abspath(
+                    f'{item["playlist"].download_folder_path}/covers/{track_name}.png')
+                self._fetch_track_cover(item['track_data'], track_name, item['cover_filename'])
+                return True
+
+            def _stage_tag(self, item):
+                """
+                Стадия 4: получение метаданных и запись тегов в файл
+
+                :param item: данные трека в конвейере
+                :return: True
+                """
+                item['track_metadata'] = self._write_track_tags(item['track_data'], item['track_name'],
+                                                                item['full_track_name'], item['cover_filename'])
+                return True
+
+            def _stage_record(self, item):
+                """
+                Стадия 5: запись трека в базу данных
+
+                :param item: данные трека в конвейере
+                :return: False (последняя стадия)
+                """
+                self._record_track_download(item['playlist'], item['track_data'], item['track_name'],
+                                            item['codec'], item['bitrate'], item['track_metadata'])
+                return False